@@ -0,0 +1,311 @@
+import json
+import socket
+import struct
+import tempfile
+import threading
+import time
+from tm_packet import TMPacket, TMSVR, TMSCT, FrameEncoder, RingBuffer, SchemaCache
+
+
+def build_svr_frame(items, transaction_id="0"):
+    """Builds a binary (mode 1) TMSVR frame like the ones the Ethernet Slave broadcasts
+
+    :param items: list of (item name, packed value bytes)
+    :param transaction_id: transaction ID of the frame
+    :return: the complete frame as bytes
+    """
+    content = b''.join(struct.pack('<H', len(name.encode('utf-8'))) + name.encode('utf-8') +
+                       struct.pack('<H', len(value)) + value for name, value in items)
+    data = f"{transaction_id},1,".encode('utf-8') + content
+    body = b'TMSVR,' + str(len(data)).encode('utf-8') + b',' + data + b','
+    return b'$' + body + b'*' + TMPacket.checksum_calc(body) + b'\r\n'
+
+
+def example_items(extra_floats=0):
+    """Items of the Default table plus an optional user defined float[] item to make the frame larger"""
+    items = [("Robot_Link", struct.pack('?', True)),
+             ("Current_Time", b"2024-06-25T15:45:30.123"),
+             ("Joint_Angle", struct.pack('6f', *range(6))),
+             ("Coord_Base_Tool", struct.pack('6f', *range(6)))]
+    if extra_floats:
+        items.append(("g_table", struct.pack(f'{extra_floats}f', *range(extra_floats))))
+    return items
+
+
+def example_values(extra_floats=0):
+    """The values of example_items, for the string and JSON frames"""
+    values = {"Robot_Link": True,
+              "Current_Time": "2024-06-25T15:45:30.123",
+              "Joint_Angle": [float(i) for i in range(6)],
+              "Coord_Base_Tool": [float(i) for i in range(6)]}
+    if extra_floats:
+        values["g_table"] = [float(i) for i in range(extra_floats)]
+    return values
+
+
+def build_text_frame(values, mode, transaction_id="0"):
+    """Builds a string (mode 2) or JSON (mode 3) TMSVR frame of the Ethernet Slave"""
+    if mode == "3":
+        content = json.dumps([{"Item": item_name, "Value": value} for item_name, value in values.items()])
+    else:
+        lines = []
+        for item_name, value in values.items():
+            # Booleans as true/false, like the robot sends them
+            lines.append(f"{item_name}={json.dumps(value) if isinstance(value, bool) else TMSVR.format_value(value)}")
+        content = "\r\n".join(lines)
+    return TMPacket.build_frame("TMSVR", f"{transaction_id},{mode},{content}".encode('utf-8'))
+
+
+def bench_svr(frame):
+    """TMSVR without a socket, its table and decode plan set up from frame"""
+    svr = TMSVR.__new__(TMSVR)
+    TMPacket.__init__(svr)
+    svr.data = RingBuffer()
+    svr.data_mode = None
+    svr.state = {"Robot_Link": ["?", False], "Current_Time": ["s", "2099-06-25T15:45:30.123"], "dt": ["i", 0],
+                 "Joint_Angle": ["f", [0.0] * 6], "Coord_Base_Tool": ["f", [0.0] * 6], "g_table": ["f", []]}
+    svr.guessed_types = {}
+    svr.init_requests()
+    # No connection, so no startup latency to measure (and log in the middle of the results)
+    svr.started = time.perf_counter()
+    svr.first_frame_latency = 0.0
+    svr.data.extend(frame)
+    svr.deserialize()
+    svr.check_ethernet_items()
+    svr.init_state()
+    return svr
+
+
+def decode_frames_per_second(frame, n_frames):
+    """Frames/second through TMSVR.deserialize and parse_data, in the data mode of frame"""
+    svr = bench_svr(frame)
+    svr.data.extend(frame * n_frames)
+    start = time.perf_counter()
+    while svr.data and svr.deserialize():
+        svr.parse_data()
+    elapsed = time.perf_counter() - start
+    assert svr.frame_count == n_frames
+    return n_frames / elapsed
+
+
+class BenchPacket(TMPacket):
+    """TMPacket reading from a socketpair or a prepared buffer, only used for benchmarking"""
+
+    def send(self, *args, **kwargs):
+        pass
+
+    def recv(self):
+        self.data.recv_into(self.sock, 2048)
+
+    def legacy_recv(self):
+        """Receive path used before RingBuffer: append each chunk and shift the buffer after every frame"""
+        self.data += bytearray(self.sock.recv(2048))
+
+    def close(self):
+        pass
+
+    def parse_data(self):
+        pass
+
+    def legacy_deserialize(self):
+        """The byte by byte scanner TMPacket.deserialize used before the find based one, kept as reference"""
+        max_ind = len(self.data)
+        index = 0
+        while index < max_ind:
+            if bytes([self.data[index]]) == TMPacket.P_HEAD:
+                break
+            index += 1
+        index += 1
+        index_i = index
+        while index < max_ind:
+            if bytes([self.data[index]]) == TMPacket.P_SEPR:
+                break
+            index += 1
+        self.header = self.data[index_i:index].decode('utf-8')
+        index += 1
+        index_i = index
+        while index < max_ind:
+            if bytes([self.data[index]]) == TMPacket.P_SEPR:
+                break
+            index += 1
+        self.length = int(self.data[index_i:index].decode('utf-8'))
+        index += 1
+        index_i = index
+        index = index + self.length
+        self.data_block = self.data[index_i:index]
+        index += 1
+        try:
+            if bytes([self.data[index]]) == TMPacket.P_CSUM:
+                self.checksum = self.data[index + 1:index + 3].decode('utf-8')
+        except IndexError:
+            return False
+        index += 5
+        data_msg = f"{self.header},{self.length},".encode('utf-8') + self.data_block + b','
+        csum = 0
+        for el in data_msg:
+            csum ^= el
+        c_sum = hex(csum)[2:].zfill(2).encode('utf-8').upper()
+        if int(self.checksum, 16) != int(c_sum, 16):
+            print("Checksum is not correct")
+        del self.data[:index]
+        return True
+
+
+def legacy_tmsct_frame(commands, script_id):
+    """The TMSCT frame as TMSCT.send built it before FrameEncoder: string concatenation and a Python XOR loop"""
+    script_data = f"{script_id},"
+    for command in commands:
+        script_data = script_data + command + "\r\n"
+    script_data = script_data[:-2]
+    data_msg = f"TMSCT,{len(script_data)},{script_data},".encode('utf-8')
+    csum = 0
+    for el in data_msg:
+        csum ^= el
+    c_sum = hex(csum)[2:].zfill(2).encode('utf-8').upper()
+    return b'$' + data_msg + b'*' + c_sum + b'\r\n'
+
+
+def example_script(n_lines):
+    return [f'Line("CPP",{i}.5,{-i}.25,300,90,0,90,100,200,0,false)' for i in range(n_lines)]
+
+
+def scripts_per_second(encode, commands, n_scripts):
+    start = time.perf_counter()
+    for i in range(n_scripts):
+        encode(commands, i)
+    return n_scripts / (time.perf_counter() - start)
+
+
+def encoder_frames(commands, n_scripts):
+    encoder = FrameEncoder()
+    for i in range(n_scripts):
+        encoder.add_script(i, commands)
+    return encoder.take()
+
+
+def send_scripts_per_second(batched, commands, n_scripts):
+    """Scripts/second encoded and written to a socketpair, one sendall per frame or one for all of them"""
+    sock, reader = socket.socketpair()
+    drain = threading.Thread(target=lambda: [None for _ in iter(lambda: reader.recv(1 << 16), b'')])
+    drain.start()
+    start = time.perf_counter()
+    if batched:
+        sock.sendall(encoder_frames(commands, n_scripts))
+    else:
+        for i in range(n_scripts):
+            sock.sendall(legacy_tmsct_frame(commands, i))
+    elapsed = time.perf_counter() - start
+    sock.close()
+    drain.join()
+    reader.close()
+    return n_scripts / elapsed
+
+
+def frames_per_second(deserialize_name, frame, n_frames):
+    packet = BenchPacket()
+    if deserialize_name == "legacy_deserialize":
+        packet.data = bytearray(frame * n_frames)
+    else:
+        packet.data = RingBuffer()
+        packet.data.extend(frame * n_frames)
+    deserialize = getattr(packet, deserialize_name)
+    start = time.perf_counter()
+    decoded = 0
+    while deserialize():
+        decoded += 1
+        if not packet.data:
+            break
+    elapsed = time.perf_counter() - start
+    assert decoded == n_frames
+    return n_frames / elapsed
+
+
+def stream_frames_per_second(legacy, frame, n_frames):
+    """Frames/second through the whole receive path, socket included, with the frames streamed over a socketpair"""
+    packet = BenchPacket()
+    packet.sock, writer = socket.socketpair()
+    packet.data = bytearray() if legacy else RingBuffer()
+    recv = packet.legacy_recv if legacy else packet.recv
+    deserialize = packet.legacy_deserialize if legacy else packet.deserialize
+    sender = threading.Thread(target=writer.sendall, args=(frame * n_frames,))
+    start = time.perf_counter()
+    sender.start()
+    decoded = 0
+    while decoded < n_frames:
+        recv()
+        # the legacy scanner cannot tell an incomplete frame apart, only call it with a full frame buffered
+        while len(packet.data) >= len(frame) and deserialize():
+            decoded += 1
+    elapsed = time.perf_counter() - start
+    sender.join()
+    packet.sock.close()
+    writer.close()
+    return n_frames / elapsed
+
+
+def run(n_frames=2000):
+    print(f"{'table':>22} {'frame bytes':>12} {'before [frames/s]':>18} {'after [frames/s]':>18} {'speedup':>8}")
+    for extra_floats in (0, 64, 512):
+        frame = build_svr_frame(example_items(extra_floats))
+        before = frames_per_second("legacy_deserialize", frame, n_frames)
+        after = frames_per_second("deserialize", frame, n_frames)
+        name = f"Default + {extra_floats} floats"
+        print(f"{name:>22} {len(frame):>12} {before:>18.0f} {after:>18.0f} {after / before:>7.1f}x")
+
+    print("\nReceive path over a socket (recv + deserialize)")
+    print(f"{'table':>22} {'frame bytes':>12} {'before [frames/s]':>18} {'after [frames/s]':>18} {'speedup':>8}")
+    for extra_floats in (0, 64, 512):
+        frame = build_svr_frame(example_items(extra_floats))
+        before = stream_frames_per_second(True, frame, n_frames)
+        after = stream_frames_per_second(False, frame, n_frames)
+        name = f"Default + {extra_floats} floats"
+        print(f"{name:>22} {len(frame):>12} {before:>18.0f} {after:>18.0f} {after / before:>7.1f}x")
+
+
+def run_encoder(n_bytes=2_000_000):
+    print("\nTMSCT frame encoding")
+    print(f"{'script lines':>22} {'frame bytes':>12} {'before [scripts/s]':>19} {'after [scripts/s]':>18} "
+          f"{'speedup':>8}")
+    for n_lines in (1, 100, 10000):
+        commands = example_script(n_lines)
+        frame = legacy_tmsct_frame(commands, 0)
+        assert frame == TMPacket.build_frame("TMSCT", TMSCT.build_script(commands, 0))
+        n_scripts = max(n_bytes // len(frame), 5)
+        before = scripts_per_second(legacy_tmsct_frame, commands, n_scripts)
+        after = scripts_per_second(lambda c, i: TMPacket.build_frame("TMSCT", TMSCT.build_script(c, i)),
+                                   commands, n_scripts)
+        print(f"{n_lines:>22} {len(frame):>12} {before:>19.0f} {after:>18.0f} {after / before:>7.1f}x")
+
+    print("\nTMSCT frames written to a socket (one sendall per frame before, one FrameEncoder batch after)")
+    print(f"{'script lines':>22} {'frame bytes':>12} {'before [scripts/s]':>19} {'after [scripts/s]':>18} "
+          f"{'speedup':>8}")
+    for n_lines in (1, 100, 10000):
+        commands = example_script(n_lines)
+        frame = legacy_tmsct_frame(commands, 0)
+        n_scripts = max(n_bytes // len(frame), 5)
+        assert encoder_frames(commands, 2) == legacy_tmsct_frame(commands, 0) + legacy_tmsct_frame(commands, 1)
+        before = send_scripts_per_second(False, commands, n_scripts)
+        after = send_scripts_per_second(True, commands, n_scripts)
+        print(f"{n_lines:>22} {len(frame):>12} {before:>19.0f} {after:>18.0f} {after / before:>7.1f}x")
+
+
+def run_modes(n_frames=2000):
+    print("\nEthernet Slave decode (deserialize + parse_data) by data mode")
+    print(f"{'table':>22} {'mode':>7} {'frame bytes':>12} {'frames/s':>10} {'us/frame':>9}")
+    for extra_floats in (0, 64, 512):
+        frames = {"binary": build_svr_frame(example_items(extra_floats)),
+                  "string": build_text_frame(example_values(extra_floats), "2"),
+                  "json": build_text_frame(example_values(extra_floats), "3")}
+        name = f"Default + {extra_floats} floats"
+        for mode, frame in frames.items():
+            rate = decode_frames_per_second(frame, n_frames)
+            print(f"{name:>22} {mode:>7} {len(frame):>12} {rate:>10.0f} {1e6 / rate:>9.1f}")
+
+
+if __name__ == "__main__":
+    # The schemas of the benchmark frames are not kept next to the real ethernet tables
+    with tempfile.TemporaryDirectory() as schemas:
+        SchemaCache.dir = schemas + "/"
+        run()
+        run_encoder()
+        run_modes()
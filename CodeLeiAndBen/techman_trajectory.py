@@ -1,4 +1,6 @@
 import tm_packet
+import tm_streaming
+import tm_io
 import tm_motion_functions_V1_80
 from pymodbus.client import ModbusTcpClient
 from rich_logging_format import rich_logger
@@ -10,70 +12,117 @@ log = rich_logger()
 
 class TM12X:
 
-    def __init__(self, ip, table_name="Default"):
+    def __init__(self, ip, table_name="Default", engine=None, svr_data_mode=None):
+        """
+        :param ip: IP of the robot
+        :param table_name: name of the ethernet table
+        :param engine: tm_io.IOEngine serving all the sockets of the robot (shared by several robots), None to use
+            a blocking Modbus client and a thread per connection
+        :param svr_data_mode: data mode of the Ethernet Slave ("binary", "string" or "json"), None to detect it
+        """
         self.TMSCT = None
         self.ip = ip
-        self.modbus = ModbusTcpClient(host=ip, port=502)
-        self.modbus.connect()
-        self.TMSVR = tm_packet.TMSVR(ip, table_name)
+        self.engine = engine
+        if engine is not None:
+            self.modbus = engine.add(tm_io.ModbusConnection(ip))
+        else:
+            self.modbus = ModbusTcpClient(host=ip, port=502)
+            self.modbus.connect()
+        self.TMSVR = tm_packet.TMSVR(ip, table_name, engine=engine, data_mode=svr_data_mode)
         log.info("Successfully connected to robot Ethernet Slave and Modbus.")
         self.motion_functions = tm_motion_functions_V1_80.TM_Motion_Functions()
         self._tcp_coord = [0.0] * 6
         self._joints = [0.0] * 6
         self.home = [663.90, -156.30, 688.15, 180.00, 90.00, 90.00]
 
-    def connect_listen_node(self, ip=None):
+    def connect_listen_node(self, ip=None, control_lane=True):
+        """
+        :param control_lane: open a second connection so stop/pause/resume never wait behind queued scripts
+        """
         if ip:
             self.ip = ip
-        self.TMSCT = tm_packet.TMSCT(self.ip)
+        self.TMSCT = tm_packet.TMSCT(self.ip, engine=self.engine)
+        if control_lane:
+            self.TMSCT.open_control_lane()
         log.info("Connected to Listen Node")
         return self.TMSCT is not None
 
+    def reconnect_modbus(self):
+        self.modbus.close()
+        if self.engine is not None:
+            self.modbus = self.engine.add(tm_io.ModbusConnection(self.ip))
+        elif not self.modbus.connect():
+            raise ConnectionError("Modbus connection failed")
+
     def close_connection(self):
         self.modbus.close()
         self.TMSVR.close()
         if self.TMSCT is not None:
             self.TMSCT.close()
 
+    def read_input_floats(self, address, count, timeout=1):
+        """32 bit floats from count input registers starting at address"""
+        if self.engine is not None:
+            registers = self.modbus.read_input_registers(address, count).result(timeout)
+            return tm_io.ModbusConnection.registers_to_floats(registers)
+        x_response = self.modbus.read_input_registers(address, count=count)
+        if not x_response or not hasattr(x_response, 'registers'):
+            raise ValueError("Invalid Modbus response.")
+        return self.modbus.convert_from_registers(x_response.registers, self.modbus.DATATYPE.FLOAT32, "big")
+
     @property
     def tcp_coord(self):
         try:
-            x_response = self.modbus.read_input_registers(7025, count=12)
-            if not x_response or not hasattr(x_response, 'registers'):
-                raise ValueError("Invalid Modbus response.")
-            self._tcp_coord = self.modbus.convert_from_registers(
-                x_response.registers, self.modbus.DATATYPE.FLOAT32, "big")
+            self._tcp_coord = self.read_input_floats(7025, 12)
         except Exception as e:
             log.warning(f"Failed to read TCP coordinates: {e}")
         return self._tcp_coord
 
     @property
     def joints(self):
-        x_response = self.modbus.read_input_registers(7013, count=12)
-        self._joints = self.modbus.convert_from_registers(x_response.registers, self.modbus.DATATYPE.FLOAT32, "big")
+        self._joints = self.read_input_floats(7013, 12)
         return self._joints
 
     def svr_write(self, item, value):
         self.TMSVR.send(item, value)
 
+    def svr_write_items(self, items):
+        """Write a dict of item name: value with one Ethernet Slave frame"""
+        self.TMSVR.send_items(items)
+
+    def svr_read_items(self, item_names, timeout=5):
+        """Values of items read on demand through the Ethernet Slave, also the ones not in its table"""
+        return self.TMSVR.read_items(item_names, timeout).result(timeout)
+
     def listen_svr_write(self, item, value):
         self.TMSCT.send(f"svr_write({item},{value})")
 
-    def path_from_csv(self, file_path, speed):
-        poses = []
+    def path_from_csv(self, file_path, speed, **kwargs):
+        return self.path(self.read_poses(file_path), speed, **kwargs)
+
+    @staticmethod
+    def read_poses(file_path):
+        """Yields the poses of a CSV file (comma or space separated) one line at a time"""
         with open(file_path) as path:
-            for pose in path.readlines():
+            for pose in path:
                 pose = pose.strip("\n")
+                if not pose:
+                    continue
                 pose = pose.split(",")
                 if len(pose) == 1:
                     pose = pose[0].split(" ")
-                poses.append(pose)
-            # print(poses)
-        self.path(poses, speed)
+                yield pose
+
+    def path(self, poses, speed, target_depth=4, wait_done=False, **kwargs):
+        """Stream a path as Line motions, in chunks that keep target_depth chunks queued on the robot
 
-    def path(self, poses, speed):
-        self.line(poses, speed)
+        :param poses: list or generator of poses, a generator is read only as fast as the robot moves
+        :return: statistics of the stream, see TrajectoryStreamer.stream
+        """
+        streamer = tm_streaming.TrajectoryStreamer(self.TMSCT, target_depth=target_depth)
         print("Path in execution")
+        return streamer.stream((self.motion_functions.line(pose, speed, **kwargs)[0] for pose in poses),
+                               wait_done=wait_done)
 
     def go_home(self, speed):
         self.ptp(self.home, speed)
@@ -84,16 +133,63 @@ class TM12X:
         # not supported by the TMFlow 1.80
 
     def wait_queue_tag(self, mode=''):
-        self.TMSCT.send(f"WaitQueueTag({mode})", queue=False)
+        """Wait on the robot for the motions queued so far
+
+        The WaitQueueTag is sent with a QueueTag of its own, reached once every motion before it is done.
+
+        Usage:
+            robot.wait_queue_tag().result(timeout=30)
+
+        :return: future done when the motions queued before are done, see tag_done
+        """
+        script = self.TMSCT.send(f"WaitQueueTag({mode})", queue=True)
         print("Waiting for queue tag")
+        return self.TMSCT.tag_done(script)
 
-    def queue_tag(self, tag_number):
-        self.TMSCT.send(f"QueueTag({tag_number}, 1)", queue=False)
+    def queue_tag(self, tag_number, wait=1):
+        """Tag the motions sent so far
+
+        The tag number is reserved in the allocator of the listen node, so it can not alias the tag of a script
+        sent with queue=True.
+
+        :return: future done when the robot reaches the tag, see tag_done
+        :raises ValueError: the tag is still live
+        """
+        script = self.TMSCT.send(f"QueueTag({tag_number}, {wait})", tag=tag_number)
         print("Waiting for queue tag")
+        return self.TMSCT.tag_done(script)
+
+    def tag_done(self, tag):
+        """Future done when a QueueTag is reached, without blocking the listen node
+
+        Usage:
+            motion = robot.line(poses, speed=100, queue=True)
+            ...  # other work while the robot moves
+            robot.tag_done(motion).result(timeout=30)
+
+        :param tag: tag number, or the future returned by a motion sent with queue=True
+        """
+        return self.TMSCT.tag_done(tag)
 
     def stop(self, mode=''):
-        self.TMSCT.send(f"StopAndClearBuffer({mode})", queue=False)
+        """Stop the robot and clear its buffer, ahead of any script still queued
+
+        What is still queued on the main connection is dropped first (TMSCT.cancel_queued), so nothing sent
+        before the stop can reach the controller after it and start the robot again.
+
+        :return: future of the reply, TMSCT.control_stats has the stop-to-ack latency
+        """
+        self.TMSCT.cancel_queued()
+        done = self.TMSCT.control(self.motion_functions.stop(mode))
+        self.TMSCT.clear_journal()
         print("Stopped")
+        return done
+
+    def pause(self):
+        return self.TMSCT.control(self.motion_functions.pause())
+
+    def resume(self):
+        return self.TMSCT.control(self.motion_functions.resume())
 
     def exit(self, mode=''):
         # print(f"ScriptExit({mode})")
@@ -102,22 +198,22 @@ class TM12X:
 
     # **kwargs allows passing extra named arguments as a dictionary.
     def ptp(self, poses, speed, queue=False, **kwargs):
-        self.TMSCT.send(self.motion_functions.ptp(poses, speed, **kwargs), queue=queue)
+        return self.TMSCT.send(self.motion_functions.ptp(poses, speed, **kwargs), queue=queue)
 
     def move_ptp(self, poses, speed, queue=False, **kwargs):
-        self.TMSCT.send(self.motion_functions.move_ptp(poses, speed, **kwargs), queue=queue)
+        return self.TMSCT.send(self.motion_functions.move_ptp(poses, speed, **kwargs), queue=queue)
 
     def line(self, poses, speed, queue=False, **kwargs):
-        self.TMSCT.send(self.motion_functions.line(poses, speed, **kwargs), queue=queue)
+        return self.TMSCT.send(self.motion_functions.line(poses, speed, **kwargs), queue=queue)
 
     def pline(self, poses, speed, queue=False, **kwargs):
-        self.TMSCT.send(self.motion_functions.pline(poses, speed, **kwargs), queue=queue)
+        return self.TMSCT.send(self.motion_functions.pline(poses, speed, **kwargs), queue=queue)
 
     def move_line(self, poses, speed, queue=False, **kwargs):
-        self.TMSCT.send(self.motion_functions.move_ptp(poses, speed, **kwargs), queue=queue)
+        return self.TMSCT.send(self.motion_functions.move_ptp(poses, speed, **kwargs), queue=queue)
 
     def circle(self, mid_point, end_point, speed, queue=False, **kwargs):
-        self.TMSCT.send(self.motion_functions.circle(mid_point, end_point, speed, **kwargs), queue=queue)
+        return self.TMSCT.send(self.motion_functions.circle(mid_point, end_point, speed, **kwargs), queue=queue)
 
     def helmet_operation_1(self, speed=20):
         try:
@@ -200,16 +296,16 @@ if __name__ == "__main__":
     #    robot.wait_queue_tag()
        input("press enter")
        robot.ptp(robot.ph3, speed=20, data_format="JPP")  # Try the poses
-       robot.wait_queue_tag()
+       robot.wait_queue_tag().result()
        input("press enter")
        robot.ptp(robot.ph4, speed=5, data_format="JPP")
-       robot.wait_queue_tag()
+       robot.wait_queue_tag().result()
        input("press enter")
        robot.ptp(robot.ph5, speed=5, data_format="CPP")
-       robot.wait_queue_tag()
+       robot.wait_queue_tag().result()
        input("press enter")
        robot.ptp(robot.p1, speed=5, data_format="CPP")
-       robot.wait_queue_tag()
+       robot.wait_queue_tag().result()
        input("press enter")
        motor.close_gripper(180, 300)
        robot.circle(robot.p2, robot.p3, speed=20)
@@ -0,0 +1,313 @@
+import asyncio
+import time
+from tm_packet import TMPacket, TMSVR, TMSCT, RingBuffer, ethernet_table
+
+
+class AsyncConnection(asyncio.BufferedProtocol):
+    """Transport side shared by the asyncio clients.
+
+    The event loop receives straight into the free space of the RingBuffer (get_buffer/buffer_updated), every
+    complete frame is deserialized as soon as it arrives and handed to frame_received. Many clients, one per robot
+    and port, can share one event loop.
+    """
+    buffer_size = 2048
+
+    def init_connection(self):
+        self.data = RingBuffer()
+        self.transport = None
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.closed = asyncio.get_running_loop().create_future()
+
+    @classmethod
+    async def open(cls, client, ip, port, timeout=10):
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(loop.create_connection(lambda: client, ip, port), timeout)
+        return client
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.data.write_view(max(sizehint, self.buffer_size))
+
+    def buffer_updated(self, nbytes):
+        self.data.advance(nbytes)
+        while self.data and self.deserialize():
+            self.frame_received()
+
+    def frame_received(self):
+        pass
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(exc)
+        self.connection_closed(exc)
+
+    def connection_closed(self, exc):
+        pass
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    async def write(self, frame):
+        """Write a frame, waits while the transport buffer is above its high water mark"""
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError("Not connected")
+        self.transport.write(frame)
+        await self.can_write.wait()
+
+    @staticmethod
+    def put_latest(queue, item):
+        """Put without blocking, the oldest queued item is dropped when the queue is full"""
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(item)
+
+    def recv(self):
+        raise NotImplementedError("Data is received by the event loop")
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self.closed)
+
+
+class AsyncTMSVR(AsyncConnection, TMSVR):
+    """Ethernet Slave (TMSVR) client for asyncio
+
+    Usage:
+        svr = await AsyncTMSVR.connect("192.168.1.10")
+        async for snapshot in svr.frames():
+            print(snapshot["Joint_Angle"])
+    """
+
+    def __init__(self, table_name="Default.json", data_mode=None):
+        TMPacket.__init__(self)
+        self.init_connection()
+        self.data_mode = self.DATA_MODES[data_mode] if data_mode is not None else None
+        self.table = ethernet_table(table_name)
+        self.state = self.table.state
+        self.received_items = []
+        self.guessed_types = {}
+        self.init_requests()
+        self.started = time.perf_counter()
+        self.first_frame_latency = None
+        # Set with the first frame, once the table is checked against its items
+        self.ready = asyncio.get_running_loop().create_future()
+        self.frame_queues = set()
+
+    @classmethod
+    async def connect(cls, ip, table_name="Default.json", port=5891, timeout=10, data_mode=None):
+        """Connect and wait for the first frame
+
+        :param ip: IP of the robot
+        :param table_name: name of the ethernet table
+        :param port: port of the Ethernet Slave
+        :param timeout: seconds to wait for the connection and the first frame
+        :param data_mode: "binary", "string" or "json", None to take it from the first frame
+        """
+        client = await cls.open(cls(table_name, data_mode), ip, port, timeout)
+        try:
+            await asyncio.wait_for(asyncio.shield(client.ready), timeout)
+        except BaseException:
+            client.close()
+            raise
+        return client
+
+    def get_received_table_items(self):
+        # The frame was already deserialized by the protocol
+        return self.read_table_items()
+
+    def frame_received(self):
+        if not self.ready.done():
+            if self.is_response(*self.split_data_block()[:2]):
+                return
+            self.check_ethernet_items()
+            self.init_state()
+            self.ready.set_result(True)
+        frame_count = self.frame_count
+        self.parse_data()
+        if self.frame_count != frame_count:
+            for queue in self.frame_queues:
+                self.put_latest(queue, self.snapshot)
+
+    def connection_closed(self, exc):
+        if not self.ready.done():
+            self.ready.set_exception(exc or ConnectionError("Connection closed before the first frame"))
+        self.fail_requests(exc)
+        for queue in self.frame_queues:
+            self.put_latest(queue, None)
+
+    async def frames(self, maxsize=100):
+        """Async iterator over the StateSnapshot of every decoded frame, ends when the connection is closed
+
+        :param maxsize: snapshots kept for a slow consumer, older ones are dropped
+        """
+        queue = asyncio.Queue(maxsize)
+        self.frame_queues.add(queue)
+        try:
+            while not self.closed.done() or not queue.empty():
+                snapshot = await queue.get()
+                if snapshot is None:
+                    break
+                yield snapshot
+        finally:
+            self.frame_queues.discard(queue)
+
+    async def send(self, item_name, value, script_id="svr"):
+        await self.send_items({item_name: value}, script_id)
+
+    async def send_items(self, items, script_id="svr"):
+        await self.write(self.build_frame("TMSVR", self.write_items_data(items, script_id)))
+
+    def new_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    async def send_acked(self, items, timeout=5.0):
+        """Write several items with a single frame and wait for the response of the robot
+
+        :return: the response message
+        :raises EthernetSlaveError: the robot rejected the values
+        """
+        transaction_id, future = self.add_request("w", timeout)
+        try:
+            await self.send_items(items, transaction_id)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pop_request(transaction_id)
+
+    async def read_items(self, item_names, timeout=5.0, ttl=None):
+        """Read items on demand with one read request (mode 11), see TMSVR.read_items
+
+        :return: dict item name: value
+        """
+        values, missing = self.cached_items(item_names, ttl)
+        if missing:
+            transaction_id, future = self.add_request("r", timeout)
+            try:
+                await self.write(self.build_frame("TMSVR", self.read_request_data(missing, transaction_id)))
+                values.update(self.cache_items(await asyncio.wait_for(future, timeout)))
+            finally:
+                self.pop_request(transaction_id)
+        return values
+
+    def start_update(self):
+        pass
+
+    def stop_update(self):
+        pass
+
+
+class AsyncTMSCT(AsyncConnection, TMSCT):
+    """Listen Node (TMSCT/TMSTA) client for asyncio
+
+    Usage:
+        listen_node = await AsyncTMSCT.connect("192.168.1.10")
+        ready, name = await listen_node.listen_ready()
+        reply = await listen_node.send("ScriptExit()")
+    """
+
+    def __init__(self, max_in_flight=100, id_space=100000, tag_poll_interval=1.0):
+        TMPacket.__init__(self)
+        self.init_connection()
+        self.header = "TMSCT"
+        self.init_tracking(asyncio.Semaphore(max_in_flight), asyncio.Queue(100), id_space)
+        self.tag_event = asyncio.Event()
+        self.tag_poll_interval = tag_poll_interval
+        self.poll_task = None
+
+    @classmethod
+    async def connect(cls, ip, port=5890, max_in_flight=100, id_space=100000, tag_poll_interval=1.0, timeout=10):
+        client = await cls.open(cls(max_in_flight, id_space, tag_poll_interval), ip, port, timeout)
+        if tag_poll_interval:
+            client.poll_task = asyncio.create_task(client.poll_tags())
+        return client
+
+    def new_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    async def poll_tags(self):
+        while not self.closed.done():
+            await asyncio.sleep(self.tag_poll_interval)
+            for tag in self.tags_to_poll():
+                if self.transport is None or self.transport.is_closing():
+                    return
+                self.transport.write(self.build_frame("TMSTA", f"01,{tag:02d}".encode('utf-8')))
+
+    async def submit(self, commands, script_id=None, queue=False):
+        """Send a script, waits only for a free slot in the in-flight window (and a free queue tag)
+
+        :return: asyncio future with the reply of the listen node, a rejected script sets a ListenNodeError
+        """
+        await self.window.acquire()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(lambda f: self.window.release())
+        try:
+            while queue and not self.ids.tag_available():
+                self.tag_event.clear()
+                await self.tag_event.wait()
+            script_id, tag = self.track(script_id, future, queue, 0, commands)
+            await self.write(self.build_frame("TMSCT", self.build_script(commands, script_id, tag)))
+        except BaseException:
+            self.untrack(future)
+            raise
+        return future
+
+    def release_tag(self, tag):
+        TMSCT.release_tag(self, tag)
+        self.tag_event.set()
+
+    async def send(self, commands, script_id=None, queue=False):
+        """Send a script and wait for its reply
+
+        :return: the reply of the listen node, "OK" or "OK;" followed by the lines with warnings
+        :raises ListenNodeError: the script was rejected
+        """
+        return await (await self.submit(commands, script_id, queue))
+
+    async def wait_all(self):
+        """Wait until every script sent got its reply"""
+        if self.pending:
+            await asyncio.wait(list(self.pending.values()))
+
+    async def request_status(self, subcommand, *args):
+        """Send a TMSTA request and wait for its response
+
+        :return: the fields of the response after the subcommand
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.status_waiters.setdefault(self.status_key(subcommand, *args), []).append(future)
+        await self.write(self.build_frame("TMSTA", ",".join((subcommand,) + args).encode('utf-8')))
+        return await future
+
+    async def listen_ready(self):
+        """:return: [True, listen node name] when the project is in a listen node, [False, ""] otherwise"""
+        fields = await self.request_status("00")
+        return [fields[0] == "true", fields[1] if len(fields) > 1 else ""]
+
+    async def tag_status(self, tag_number):
+        """:return: "true" when the QueueTag is done, "false" when not, "none" when the tag does not exist"""
+        fields = await self.request_status("01", f"{tag_number:02d}")
+        return fields[1]
+
+    async def listen_messages(self):
+        """Async iterator over (header, fields) of the messages that do not answer a request"""
+        while not self.closed.done() or not self.messages.empty():
+            message = await self.messages.get()
+            if message is None:
+                break
+            yield message
+
+    def frame_received(self):
+        self.parse_data()
+
+    def connection_closed(self, exc):
+        TMSCT.connection_closed(self, exc)
+        if self.poll_task is not None:
+            self.poll_task.cancel()
@@ -0,0 +1,166 @@
+import csv
+import glob
+import json
+import os
+import struct
+import numpy as np
+
+# File layout of every chunk:
+#   MAGIC (8 bytes) | header length (uint32, little endian) | JSON header | padding up to HEADER_ALIGN
+#   followed by fixed width records described by the "columns" of the header.
+MAGIC = b'TMLOG001'
+HEADER_ALIGN = 64
+EXTENSION = ".tmlog"
+
+
+def log_base(filename):
+    return filename[:-len(EXTENSION)] if filename.endswith(EXTENSION) else filename
+
+
+def chunk_name(filename, chunk):
+    """Name of a chunk file, log.tmlog -> log.0000.tmlog, log.0001.tmlog, ..."""
+    return f"{log_base(filename)}.{chunk:04d}{EXTENSION}"
+
+
+def record_dtype(columns):
+    """NumPy dtype of a record from the header columns, a list of [name, dtype, shape]"""
+    return np.dtype([(name, dtype, tuple(shape)) for name, dtype, shape in columns])
+
+
+class BinaryLogWriter:
+    """Writes a time stamp and the selected items of every frame as fixed width binary records.
+
+    Records are collected in a preallocated NumPy block and written with one call when the block is full, and a
+    new chunk file is started every chunk_records records. Every chunk starts with a small JSON header describing
+    the columns, so each one can be opened with np.memmap on its own.
+    """
+
+    def __init__(self, filename, columns, chunk_records=100000, block_records=256):
+        """
+        :param filename: name of the log, the chunks are named after it (see chunk_name)
+        :param columns: list of [item name, NumPy dtype, shape], see TMSVR.log_columns
+        :param chunk_records: number of records per chunk file
+        :param block_records: number of records buffered before writing to the file
+        """
+        self.filename = filename
+        self.columns = [["time", "<f8", []]] + [list(column) for column in columns]
+        self.items = [name for name, dtype, shape in columns]
+        self.dtype = record_dtype(self.columns)
+        self.chunk_records = chunk_records
+        self.block = np.zeros(block_records, dtype=self.dtype)
+        self.block_count = 0
+        self.chunk = 0
+        self.chunk_count = 0
+        self.records = 0
+        self.file = None
+        self.open_chunk()
+
+    def header(self):
+        header = json.dumps({"columns": self.columns,
+                             "record_size": self.dtype.itemsize,
+                             "chunk": self.chunk}).encode('utf-8')
+        size = len(MAGIC) + 4 + len(header)
+        padding = -size % HEADER_ALIGN
+        return MAGIC + struct.pack('<I', len(header) + padding) + header + b' ' * padding
+
+    def open_chunk(self):
+        self.file = open(chunk_name(self.filename, self.chunk), 'wb')
+        self.file.write(self.header())
+        self.chunk_count = 0
+
+    def write(self, timestamp, snapshot):
+        """Add the record of a frame
+
+        :param timestamp: time stamp of the frame
+        :param snapshot: StateSnapshot (or any mapping) with the values of the items
+        """
+        record = self.block[self.block_count]
+        record["time"] = timestamp
+        for item_name in self.items:
+            value = snapshot[item_name]
+            record[item_name] = value.encode('utf-8') if isinstance(value, str) else value
+        self.block_count += 1
+        if self.block_count == len(self.block):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records, starting new chunks when the current one is full"""
+        written = 0
+        while written < self.block_count:
+            if self.chunk_count == self.chunk_records:
+                self.file.close()
+                self.chunk += 1
+                self.open_chunk()
+            n = min(self.block_count - written, self.chunk_records - self.chunk_count)
+            self.file.write(memoryview(self.block[written:written + n]).cast('B'))
+            written += n
+            self.chunk_count += n
+        self.records += self.block_count
+        self.block_count = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_header(chunk_file):
+    """Header of a chunk file and the offset of its first record"""
+    with open(chunk_file, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{chunk_file} is not a binary TM log")
+        header_length = struct.unpack('<I', file.read(4))[0]
+        header = json.loads(file.read(header_length))
+    return header, len(MAGIC) + 4 + header_length
+
+
+def load_binary_log(filename, mmap=False):
+    """Load a binary log as a NumPy structured array, one field per column ("time" and the items)
+
+    :param filename: name the log was written with, or the name of a single chunk
+    :param mmap: return a list with one read only np.memmap per chunk instead of one array in memory
+    """
+    chunks = sorted(glob.glob(glob.escape(log_base(filename)) + f".[0-9][0-9][0-9][0-9]{EXTENSION}"))
+    if not chunks and os.path.exists(filename):
+        chunks = [filename]
+    if not chunks:
+        raise FileNotFoundError(f"No binary log named {filename}")
+
+    arrays = []
+    for chunk_file in chunks:
+        header, offset = read_header(chunk_file)
+        dtype = record_dtype(header["columns"])
+        # A record that was being written when the log stopped is ignored
+        n_records = (os.path.getsize(chunk_file) - offset) // dtype.itemsize
+        if mmap:
+            if n_records:
+                arrays.append(np.memmap(chunk_file, dtype=dtype, mode='r', offset=offset, shape=(n_records,)))
+        else:
+            arrays.append(np.fromfile(chunk_file, dtype=dtype, count=n_records, offset=offset))
+    if mmap:
+        return arrays
+    return np.concatenate(arrays) if len(arrays) > 1 else arrays[0]
+
+
+def binary_log_to_csv(filename, csv_filename, include_time=False):
+    """Convert a binary log to the CSV written by TMSVR.start_logging: one row per frame, arrays flattened
+
+    :param filename: name of the binary log
+    :param csv_filename: name of the CSV file to write
+    :param include_time: write the time stamp as the first column
+    """
+    records = load_binary_log(filename)
+    names = [name for name in records.dtype.names if include_time or name != "time"]
+    with open(csv_filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        for record in records.tolist():
+            row = []
+            for name, value in zip(records.dtype.names, record):
+                if name not in names:
+                    continue
+                if isinstance(value, bytes):
+                    row.append(value.decode('utf-8'))
+                elif isinstance(value, np.ndarray):
+                    row.extend(value.tolist())
+                else:
+                    row.append(value)
+            writer.writerow(row)
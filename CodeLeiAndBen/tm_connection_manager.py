@@ -0,0 +1,242 @@
+import random
+import threading
+import time
+from tm_packet import log
+
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+RECONNECTING = "reconnecting"
+
+
+class Link:
+    """A connection watched by the ConnectionManager"""
+
+    def __init__(self, name, check, reconnect):
+        """
+        :param name: name of the link in the events, like "TMSVR"
+        :param check: function returning True while the link is alive
+        :param reconnect: function opening the link again, raises when it fails
+        """
+        self.name = name
+        self.check = check
+        self.reconnect = reconnect
+        self.state = CONNECTED
+        self.error = None
+        self.backoff = 0.0
+        self.next_attempt = 0.0
+        self.reconnects = 0
+        self.failures = 0
+
+
+class StreamWatch:
+    """Check of a TMSVR: the frame count has to move within stall_timeout"""
+
+    def __init__(self, svr, stall_timeout=0.5):
+        self.svr = svr
+        self.stall_timeout = stall_timeout
+        self.frame_count = svr.frame_count
+        self.last_frame = time.monotonic()
+
+    def __call__(self):
+        now = time.monotonic()
+        if self.svr.frame_count != self.frame_count:
+            self.frame_count = self.svr.frame_count
+            self.last_frame = now
+        if self.svr.connection is not None and self.svr.connection.closed:
+            return False
+        if self.svr.connection is None and not self.svr.updating:
+            return False
+        return now - self.last_frame < self.stall_timeout
+
+    def reset(self):
+        self.frame_count = self.svr.frame_count
+        self.last_frame = time.monotonic()
+
+
+class KeepaliveWatch:
+    """Check of a TMSCT: a TMSTA 00 request every interval has to be answered within timeout"""
+
+    def __init__(self, listen_node, interval=1.0, timeout=1.0):
+        self.listen_node = listen_node
+        self.interval = interval
+        self.timeout = timeout
+        self.request = None
+        self.sent = 0.0
+
+    def __call__(self):
+        now = time.monotonic()
+        if self.listen_node.connection is not None and self.listen_node.connection.closed:
+            return False
+        if self.listen_node.connection is None and not self.listen_node.reader_thread.is_alive():
+            return False
+        if self.request is not None:
+            if self.request.done():
+                if self.request.exception() is not None:
+                    return False
+                self.request = None
+            elif now - self.sent > self.timeout:
+                return False
+        if self.request is None and now - self.sent >= self.interval:
+            try:
+                self.request = self.listen_node.request_status("00")
+            except OSError:
+                return False
+            self.sent = now
+        return True
+
+    def reset(self):
+        self.request = None
+        self.sent = 0.0
+
+
+class ConnectionManager:
+    """Watches the connections of robots and opens them again when they drop.
+
+    A thread checks every link each check_interval: the Ethernet Slave stream has to keep moving, the listen node
+    has to answer a keepalive request and the Modbus server a register read. A dead link is reconnected with
+    exponential backoff (with jitter) up to backoff_max seconds, and every state change (connected, disconnected,
+    reconnecting) is sent to the listeners.
+
+    Usage:
+        manager = ConnectionManager()
+        manager.add_listener(lambda name, state, error: print(name, state, error))
+        manager.watch_robot(robot)
+        manager.start()
+    """
+
+    def __init__(self, check_interval=0.1, backoff_initial=0.5, backoff_max=10.0):
+        self.check_interval = check_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.links = {}
+        self.listeners = []
+        self.changed = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def watch(self, name, check, reconnect):
+        self.links[name] = Link(name, check, reconnect)
+        return self.links[name]
+
+    def watch_tmsvr(self, svr, name="TMSVR", stall_timeout=0.5):
+        """Reconnect the Ethernet Slave when no frame arrives for stall_timeout seconds"""
+        check = StreamWatch(svr, stall_timeout)
+
+        def reconnect():
+            svr.reconnect()
+            check.reset()
+        return self.watch(name, check, reconnect)
+
+    def watch_tmsct(self, listen_node, name="TMSCT", keepalive_interval=1.0, keepalive_timeout=1.0, resume=False):
+        """Reconnect the listen node when a keepalive is not answered
+
+        The control lane, when it is open, is watched as the link "<name> control".
+
+        :param resume: once the listen node is ready again, send again the queued scripts not confirmed by their
+            QueueTag (TMSCT.resume). A dropped link does not clear the motion buffer of the controller, so a script
+            it already holds (its QueueTag just not reported yet) runs twice. Only for scripts that are safe to
+            repeat, or after clearing the buffer of the robot
+        """
+        check = KeepaliveWatch(listen_node, keepalive_interval, keepalive_timeout)
+
+        def reconnect():
+            listen_node.reconnect()
+            check.reset()
+            ready, node_name = listen_node.listen_ready(timeout=keepalive_timeout)
+            if not ready:
+                raise ConnectionError("The project is not in a listen node")
+            if resume:
+                listen_node.resume()
+        if listen_node.control_lane is not None:
+            self.watch_tmsct(listen_node.control_lane, name + " control", keepalive_interval, keepalive_timeout)
+        return self.watch(name, check, reconnect)
+
+    def watch_modbus(self, robot, name="Modbus", address=7013, interval=1.0, timeout=1.0):
+        """Reconnect the Modbus client of a TM12X when a register read (one every interval seconds) fails"""
+        last_read = [0.0]
+
+        def check():
+            if time.monotonic() - last_read[0] < interval:
+                return True
+            last_read[0] = time.monotonic()
+            try:
+                robot.read_input_floats(address, 2, timeout)
+                return True
+            except Exception:
+                return False
+
+        def reconnect():
+            robot.reconnect_modbus()
+        return self.watch(name, check, reconnect)
+
+    def watch_robot(self, robot, prefix=""):
+        """Watch all the connections of a TM12X (the listen node only if it is connected)"""
+        self.watch_modbus(robot, prefix + "Modbus")
+        self.watch_tmsvr(robot.TMSVR, prefix + "TMSVR")
+        if robot.TMSCT is not None:
+            self.watch_tmsct(robot.TMSCT, prefix + "TMSCT")
+
+    def add_listener(self, callback):
+        """callback(name, state, error) is called from the manager thread on every state change"""
+        self.listeners.append(callback)
+
+    def set_state(self, link, state, error=None):
+        link.state = state
+        link.error = error
+        with self.changed:
+            self.changed.notify_all()
+        log.info(f"{link.name} {state}" + (f": {error}" if error else ""))
+        for callback in self.listeners:
+            try:
+                callback(link.name, state, error)
+            except Exception as e:
+                log.error(f"Connection listener failed: {e}")
+
+    def state(self, name=None):
+        """State of a link, or of all of them as a dict"""
+        if name is not None:
+            return self.links[name].state
+        return {name: link.state for name, link in self.links.items()}
+
+    def wait_connected(self, name=None, timeout=None):
+        """Wait until a link (all of them when name is None) is connected"""
+        links = [self.links[name]] if name is not None else list(self.links.values())
+        with self.changed:
+            return self.changed.wait_for(lambda: all(link.state == CONNECTED for link in links), timeout)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            for link in list(self.links.values()):
+                if link.state == CONNECTED:
+                    if not link.check():
+                        link.failures += 1
+                        link.backoff = 0.0
+                        link.next_attempt = now
+                        self.set_state(link, DISCONNECTED)
+                elif now >= link.next_attempt:
+                    self.set_state(link, RECONNECTING)
+                    try:
+                        link.reconnect()
+                    except Exception as e:
+                        link.backoff = min(max(2 * link.backoff, self.backoff_initial), self.backoff_max)
+                        link.next_attempt = time.monotonic() + link.backoff * random.uniform(0.8, 1.2)
+                        self.set_state(link, DISCONNECTED, e)
+                    else:
+                        link.reconnects += 1
+                        self.set_state(link, CONNECTED)
+            time.sleep(self.check_interval)
+
+    def stats(self):
+        return {name: {"state": link.state, "failures": link.failures, "reconnects": link.reconnects}
+                for name, link in self.links.items()}
@@ -0,0 +1,399 @@
+import collections
+import selectors
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from tm_packet import RingBuffer, log
+
+
+class Connection:
+    """Non-blocking socket served by an IOEngine.
+
+    Reads go into a RingBuffer and are handed to data_received, writes are appended to an output buffer by any
+    thread and sent by the engine thread as the socket accepts them.
+    """
+
+    def __init__(self, sock, name, data=None, read_size=65536):
+        """
+        :param sock: connected socket, it is switched to non-blocking
+        :param name: name of the connection in the stats, like "192.168.1.2:5891"
+        :param data: RingBuffer to receive into, a new one when None
+        :param read_size: maximum bytes per recv
+        """
+        sock.setblocking(False)
+        self.sock = sock
+        self.name = name
+        self.data = data if data is not None else RingBuffer()
+        self.read_size = read_size
+        self.engine = None
+        self.out = bytearray()
+        # Length of every message queued in out, the first one has out_sent bytes already sent
+        self.out_messages = collections.deque()
+        self.out_sent = 0
+        self.out_lock = threading.Lock()
+        self.closed = False
+        self.started = time.monotonic()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reads = 0
+        self.writes = 0
+        self.out_high_water = 0
+
+    def handle_read(self):
+        while True:
+            try:
+                received = self.data.recv_into(self.sock, self.read_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.handle_close(e)
+                return
+            if not received:
+                self.handle_close(None)
+                return
+            self.bytes_in += received
+            self.reads += 1
+            if received < self.read_size:
+                break
+        self.data_received()
+
+    def data_received(self):
+        pass
+
+    def write(self, data):
+        """Queue data to send, can be called from any thread"""
+        if self.closed:
+            raise ConnectionError(f"{self.name} is closed")
+        with self.out_lock:
+            self.out += data
+            self.out_messages.append(len(data))
+            self.out_high_water = max(self.out_high_water, len(self.out))
+        self.engine.call_soon(self.handle_write)
+
+    def discard_output(self):
+        """Drop the messages queued and not sent yet
+
+        A message already partly sent is finished, the peer would not make sense of half a frame.
+
+        :return: number of bytes dropped
+        """
+        with self.out_lock:
+            keep = self.out_messages[0] - self.out_sent if self.out_sent else 0
+            dropped = len(self.out) - keep
+            del self.out[keep:]
+            if keep:
+                while len(self.out_messages) > 1:
+                    self.out_messages.pop()
+            else:
+                self.out_messages.clear()
+        return dropped
+
+    def handle_write(self):
+        with self.out_lock:
+            while self.out:
+                try:
+                    sent = self.sock.send(self.out)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError as e:
+                    self.out.clear()
+                    self.out_messages.clear()
+                    self.out_sent = 0
+                    self.engine.call_soon(self.handle_close, e)
+                    return
+                del self.out[:sent]
+                self.out_sent += sent
+                while self.out_messages and self.out_sent >= self.out_messages[0]:
+                    self.out_sent -= self.out_messages.popleft()
+                self.bytes_out += sent
+                self.writes += 1
+            waiting = bool(self.out)
+        if not self.closed:
+            self.engine.want_write(self, waiting)
+
+    def handle_close(self, exc):
+        if self.closed:
+            return
+        self.closed = True
+        self.engine.remove(self)
+        self.sock.close()
+        self.connection_closed(exc)
+
+    def connection_closed(self, exc):
+        log.warning(f"{self.name} closed: {exc}")
+
+    def close(self):
+        """Close from any thread
+
+        :return: future done once the engine closed the socket and called connection_closed
+        """
+        closed = Future()
+        self.engine.call_soon(self.close_now, closed)
+        return closed
+
+    def close_now(self, closed):
+        try:
+            self.handle_close(None)
+        finally:
+            closed.set_result(True)
+
+    def close_wait(self, timeout=None):
+        """Close and wait until the engine is done with the socket and the receive buffer"""
+        if threading.current_thread() is self.engine.thread:
+            self.handle_close(None)
+        else:
+            self.close().result(timeout)
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {"bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "in_rate": self.bytes_in / elapsed,
+                "out_rate": self.bytes_out / elapsed,
+                "reads": self.reads,
+                "writes": self.writes,
+                "out_queued": len(self.out),
+                "out_high_water": self.out_high_water}
+
+
+class PacketConnection(Connection):
+    """Serves a TMSVR or TMSCT: every complete frame received is parsed by the packet itself"""
+
+    def __init__(self, packet, name):
+        super().__init__(packet.sock, name, packet.data, packet.buffer_size)
+        self.packet = packet
+        self.frames = 0
+
+    def data_received(self):
+        packet = self.packet
+        while packet.data and packet.deserialize():
+            packet.parse_data()
+            self.frames += 1
+
+    def connection_closed(self, exc):
+        self.packet.connection_closed(exc)
+
+    def stats(self):
+        stats = super().stats()
+        stats["frames"] = self.frames
+        stats["frame_rate"] = self.frames / max(time.monotonic() - self.started, 1e-9)
+        return stats
+
+
+class ModbusConnection(Connection):
+    """Modbus TCP client served by an IOEngine, the replies are matched to the requests by transaction ID"""
+    MBAP = struct.Struct('>HHHB')
+
+    def __init__(self, ip, port=502, unit=1, timeout=10):
+        sock = socket.create_connection((ip, port), timeout)
+        super().__init__(sock, f"{ip}:{port}")
+        self.unit = unit
+        self.transaction_id = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    @property
+    def connected(self):
+        return not self.closed
+
+    def request(self, function, payload, unit=None):
+        """Send a request PDU
+
+        :return: future of the response PDU data (after the function code)
+        """
+        future = Future()
+        with self.lock:
+            self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+            transaction_id = self.transaction_id
+            self.pending[transaction_id] = future
+        pdu = bytes([function]) + payload
+        self.write(self.MBAP.pack(transaction_id, 0, len(pdu) + 1, self.unit if unit is None else unit) + pdu)
+        return future
+
+    def read_registers(self, function, address, count, unit=None):
+        future = Future()
+
+        def decode(response):
+            if response.exception() is not None:
+                future.set_exception(response.exception())
+            else:
+                data = response.result()
+                future.set_result(list(struct.unpack(f'>{data[0] // 2}H', data[1:1 + data[0]])))
+        self.request(function, struct.pack('>HH', address, count), unit).add_done_callback(decode)
+        return future
+
+    def read_input_registers(self, address, count, unit=None):
+        """:return: future of the list of register values"""
+        return self.read_registers(0x04, address, count, unit)
+
+    def read_holding_registers(self, address, count, unit=None):
+        """:return: future of the list of register values"""
+        return self.read_registers(0x03, address, count, unit)
+
+    @staticmethod
+    def registers_to_floats(registers):
+        """32 bit floats from pairs of registers, big endian words (like convert_from_registers FLOAT32 "big")"""
+        return list(struct.unpack(f'>{len(registers) // 2}f', struct.pack(f'>{len(registers)}H', *registers)))
+
+    def data_received(self):
+        ring = self.data
+        while len(ring) >= self.MBAP.size:
+            transaction_id, protocol, length, unit = self.MBAP.unpack_from(ring.buffer, ring.start)
+            end = ring.start + 6 + length
+            if ring.end < end:
+                break
+            function = ring.buffer[ring.start + self.MBAP.size]
+            data = bytes(ring.view[ring.start + self.MBAP.size + 1:end])
+            ring.consume(6 + length)
+            with self.lock:
+                future = self.pending.pop(transaction_id, None)
+            if future is None:
+                continue
+            if function & 0x80:
+                future.set_exception(IOError(f"Modbus exception {data[0]} for function {function & 0x7F}"))
+            else:
+                future.set_result(data)
+
+    def connection_closed(self, exc):
+        super().connection_closed(exc)
+        with self.lock:
+            futures = list(self.pending.values())
+            self.pending.clear()
+        for future in futures:
+            future.set_exception(exc or ConnectionError(f"{self.name} closed"))
+
+
+class IOEngine:
+    """One thread serving the sockets of any number of robots (Ethernet Slave, listen node, Modbus) through a
+    selector, with non-blocking reads and writes and per connection statistics.
+
+    Usage:
+        engine = IOEngine()
+        robot_1 = TM12X("192.168.1.2", engine=engine)
+        robot_2 = TM12X("192.168.1.3", engine=engine)
+        print(engine.stats())
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        self.connections = []
+        self.calls = collections.deque()
+        # [next time, interval, function]
+        self.timers = []
+        self.running = False
+        self.thread = None
+        self.loops = 0
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def add(self, connection):
+        """Serve a connection, starts the engine thread if needed"""
+        connection.engine = self
+        self.connections.append(connection)
+        self.call_soon(self.selector.register, connection.sock, selectors.EVENT_READ, connection)
+        self.start()
+        return connection
+
+    def add_packet(self, packet, name):
+        """Serve the socket of a TMSVR or TMSCT, see PacketConnection"""
+        return self.add(PacketConnection(packet, name))
+
+    def remove(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+            self.selector.unregister(connection.sock)
+
+    def want_write(self, connection, waiting):
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if waiting else selectors.EVENT_READ
+        if self.selector.get_key(connection.sock).events != events:
+            self.selector.modify(connection.sock, events, connection)
+
+    def call_soon(self, function, *args):
+        """Run function in the engine thread, can be called from any thread"""
+        self.calls.append((function, args))
+        if threading.current_thread() is not self.thread:
+            try:
+                self.wakeup_send.send(b'\0')
+            except (BlockingIOError, InterruptedError):
+                pass
+
+    def call_every(self, interval, function):
+        """Run function in the engine thread every interval seconds
+
+        :return: the timer, to stop it with cancel
+        """
+        timer = [time.monotonic() + interval, interval, function]
+        self.call_soon(self.timers.append, timer)
+        return timer
+
+    def cancel(self, timer):
+        """Stop a timer returned by call_every, can be called from any thread"""
+        self.call_soon(self.remove_timer, timer)
+
+    def remove_timer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def run(self):
+        while self.running:
+            timeout = None
+            if self.timers:
+                timeout = max(0.0, min(timer[0] for timer in self.timers) - time.monotonic())
+            if self.calls:
+                timeout = 0
+            for key, mask in self.selector.select(timeout):
+                connection = key.data
+                if connection is None:
+                    try:
+                        while self.wakeup_recv.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                # A failure of one connection (a frame its packet can not parse) closes only that connection
+                try:
+                    if mask & selectors.EVENT_READ:
+                        connection.handle_read()
+                    if mask & selectors.EVENT_WRITE and not connection.closed:
+                        connection.handle_write()
+                except Exception as e:
+                    log.error(f"I/O engine connection {connection.name} failed: {e}")
+                    connection.handle_close(e)
+            while self.calls:
+                function, args = self.calls.popleft()
+                try:
+                    function(*args)
+                except Exception as e:
+                    log.error(f"I/O engine call {function} failed: {e}")
+            now = time.monotonic()
+            for timer in self.timers:
+                if timer[0] <= now:
+                    timer[0] = now + timer[1]
+                    try:
+                        timer[2]()
+                    except Exception as e:
+                        log.error(f"I/O engine timer {timer[2]} failed: {e}")
+            self.loops += 1
+
+    def stats(self):
+        """Throughput statistics of every connection, by name"""
+        return {connection.name: connection.stats() for connection in list(self.connections)}
+
+    def stop(self):
+        for connection in list(self.connections):
+            connection.close()
+        self.call_soon(setattr, self, "running", False)
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=2)
+        self.thread = None
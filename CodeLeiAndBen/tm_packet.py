@@ -1,14 +1,21 @@
 import struct
 import socket
+import operator
+import re
 import time
 from abc import ABC, abstractmethod
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 from rich.logging import RichHandler
 import threading
+import queue
+from concurrent.futures import Future, wait
 import csv
+import hashlib
 import json
 import os
+import numpy as np
+from tm_binary_log import BinaryLogWriter
 
 FORMAT = '%(message)s'
 logging.basicConfig(
@@ -25,6 +32,8 @@ class TMPacket(ABC):
     P_SEPR = b'\x2C'  # ','
     P_CSUM = b'\x2A'  # '*'
     P_LSEP = b'\x3B'  # ';'
+    # Below this size checksum_calc XORs byte by byte
+    CHECKSUM_LOOP_MAX = 96
 
     def __init__(self):
         self.data = None
@@ -32,6 +41,11 @@ class TMPacket(ABC):
         self.length = None
         self.data_block = None
         self.checksum = None
+        # False when the checksum of the last frame deserialized did not match its content
+        self.checksum_ok = True
+        # Set when the socket is served by an IOEngine (tm_io)
+        self.connection = None
+        self.send_lock = threading.Lock()
 
     @abstractmethod
     def send(self, *args, **kwargs):
@@ -47,81 +61,247 @@ class TMPacket(ABC):
 
     @staticmethod
     def checksum_calc(data_msg):
-        # data_msg = data_msg.encode('utf-8')
-        csum = 0
-        for el in data_msg:
-            csum ^= el
-        return hex(csum)[2:].zfill(2).encode('utf-8').upper()
+        """XOR of all the bytes in data_msg as the two upper case hex characters used by the TM protocol.
+
+        The message is folded as one big integer, halving its width at every step, so the number of
+        operations grows with log2(len(data_msg)) instead of looping over every byte in Python. Short
+        messages (a one line script) are faster with the plain loop than with the fixed cost of the fold.
+        """
+        n = len(data_msg)
+        if n < TMPacket.CHECKSUM_LOOP_MAX:
+            csum = 0
+            for byte in data_msg:
+                csum ^= byte
+            return b'%02X' % csum
+        csum = int.from_bytes(data_msg, 'little')
+        while n > 1:
+            half = (n + 1) >> 1
+            csum = (csum & ((1 << (half << 3)) - 1)) ^ (csum >> (half << 3))
+            n = half
+        return b'%02X' % csum
+
+    @staticmethod
+    def build_frame(header, data):
+        """Complete frame ($header,length,data,*checksum\\r\\n) for data given as bytes"""
+        body = b'%s,%d,%s,' % (header.encode('utf-8'), len(data), data)
+        return b'$%s*%s\r\n' % (body, TMPacket.checksum_calc(body))
+
+    def write_frame(self, frame):
+        """Send one or more complete frames with a single write, queued to the IOEngine when the socket is served
+        by one"""
+        if self.connection is not None:
+            self.connection.write(frame)
+        else:
+            with self.send_lock:
+                self.sock.sendall(frame)
+
+    def connection_closed(self, exc):
+        pass
 
     def deserialize(self):
-        max_ind = len(self.data)
-        index = 0
-        # Find the beginning of the packet
-        while index < max_ind:
-            if bytes([self.data[index]]) == TMPacket.P_HEAD:
-                break
-            index += 1
-
-        index += 1
-        index_i = index
-        # Now index is the index of the first character of the header
-        # Find packet header
-        while index < max_ind:
-            if bytes([self.data[index]]) == TMPacket.P_SEPR:
-                index_end = index
-                break
-            index += 1
-
-        # now index is at separator (',') after header
-        self.header = self.data[index_i:index].decode('utf-8')
-        # print(f"header: {self.header} \n")
-
-        index += 1
-        index_i = index
-        # Now index is the first byte of the length of data
-        # Find packet length
-        while index < max_ind:
-            if bytes([self.data[index]]) == TMPacket.P_SEPR:
-                break
-            index += 1
-
-        # now index is at separator (',') after packet length
-        self.length = int(self.data[index_i:index].decode('utf-8'))
-        # print(f"Data length: {self.length} \n")
-
-        index += 1
-        index_i = index
-
-        # Now index is the first byte of the data
-        # Find packet data
-        index = index + self.length
-        self.data_block = self.data[index_i:index]
-        # Checksum
-        index += 1
-        # print(f"csum: {bytes([self.data[index]]).decode('utf-8')} \n")
-        # print(self.data[index + 1:index + 3].decode('utf-8'))
-        try:
-            if bytes([self.data[index]]) == TMPacket.P_CSUM:                    # if data length is greater than the number of bytes in the buffer return False
-                self.checksum = self.data[index + 1:index + 3].decode('utf-8')
-        except IndexError:
-            return False
+        """Extract the next complete frame from the receive buffer self.data (a RingBuffer).
+
+        Every field is located with bytearray.find inside the unread window of the buffer, so a frame
+        costs a constant number of C-level scans no matter how large the data block is. data_block is
+        a memoryview into the buffer, valid until the next recv. Bytes before the next '$' are
+        discarded, and a frame that is still incomplete is left in the buffer for the next recv.
 
-        index += 5
-        c_sum = self.checksum_calc(f"{self.header},{self.length},".encode('utf-8') + self.data_block + b',')
-        if int(self.checksum, 16) != int(c_sum, 16):
+        :return: True if a frame was extracted, False if more data is needed
+        """
+        ring = self.data
+        data = ring.buffer
+        while True:
+            head = data.find(TMPacket.P_HEAD, ring.start, ring.end)
+            if head < 0:
+                ring.clear()
+                return False
+            ring.start = head
+
+            # now data[head] is '$', the header ends at the first separator
+            header_end = data.find(TMPacket.P_SEPR, head + 1, ring.end)
+            if header_end < 0:
+                return False
+            length_end = data.find(TMPacket.P_SEPR, header_end + 1, ring.end)
+            if length_end < 0:
+                return False
+            try:
+                length = int(data[header_end + 1:length_end])
+            except ValueError:
+                # Not a real frame head, resynchronize on the next '$'
+                ring.consume(1)
+                continue
+
+            block_start = length_end + 1
+            csum_index = block_start + length + 1
+            frame_end = csum_index + 5
+            if ring.end < frame_end:
+                return False
+            if data[csum_index] != TMPacket.P_CSUM[0]:
+                ring.consume(1)
+                continue
+            break
+
+        view = ring.view
+        self.header = str(view[head + 1:header_end], 'utf-8')
+        self.length = length
+        self.data_block = view[block_start:block_start + length]
+        self.checksum = str(view[csum_index + 1:csum_index + 3], 'utf-8')
+
+        c_sum = self.checksum_calc(view[head + 1:csum_index])
+        self.checksum_ok = int(self.checksum, 16) == int(c_sum, 16)
+        if not self.checksum_ok:
             print("Checksum is not correct")
-        # print(f"Data: {self.data[index_i:index]} \n")
-        # self.get_item_values(self.data[index_i:index])
-        # index += 7
 
-        del self.data[:index]
+        ring.consume(frame_end - head)
         return True
+
     @abstractmethod
     def parse_data(self):
         pass
 
 
+class FrameEncoder:
+    """Builds TM frames straight into one bytearray, so many frames go out with a single sendall.
+
+    The head, length, data parts and checksum of each frame are appended to the buffer once, without building
+    intermediate strings, and the checksum is folded over the bytes already in the buffer.
+
+    Usage:
+        encoder = FrameEncoder()
+        for script in scripts:
+            encoder.add_script(script_id, script)
+        sock.sendall(encoder.take())
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.count = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def add(self, header, *parts):
+        """Append a frame whose data block is the concatenation of parts (bytes-like)"""
+        buffer = self.buffer
+        head = len(buffer)
+        buffer += b'$%s,%d,' % (header.encode('utf-8'), sum(map(len, parts)))
+        for part in parts:
+            buffer += part
+        buffer += b','
+        csum = TMPacket.checksum_calc(memoryview(buffer)[head + 1:])
+        buffer += b'*%s\r\n' % csum
+        self.count += 1
+        return self
+
+    def add_script(self, script_id, commands, tag=None):
+        """Append a TMSCT frame, see TMSCT.build_script"""
+        return self.add("TMSCT", TMSCT.build_script(commands, script_id, tag))
+
+    def take(self):
+        """The frames built so far, the encoder starts over empty"""
+        frames = self.buffer
+        self.buffer = bytearray()
+        self.count = 0
+        return frames
+
+
+class ListenNodeError(Exception):
+    """The listen node rejected a script (ERROR reply) or a packet (CPERR)"""
+
+    def __init__(self, script_id, reply):
+        super().__init__(f"Script {script_id}: {reply}")
+        self.script_id = script_id
+        self.reply = reply
+
+
+class ScriptsStopped(Exception):
+    """The scripts queued on the listen node were dropped by a stop (TMSCT.cancel_queued)"""
+
+
+class EthernetSlaveError(Exception):
+    """The Ethernet Slave rejected a request (server response with a code other than 00)"""
+
+    def __init__(self, transaction_id, code, message=""):
+        # The message starts with the name of the code, like NotExist;Ctrl_DO32
+        super().__init__(f"Request {transaction_id}: {code} {message or TMSVR.RESPONSE_CODES.get(code, '')}".rstrip())
+        self.transaction_id = transaction_id
+        self.code = code
+        self.message = message
+
+
+class RingBuffer:
+    """Preallocated receive buffer filled with socket.recv_into and read through memoryview windows.
+
+    Unread bytes live in buffer[start:end]. Consuming a frame only moves start, and once the buffer is
+    empty both indices go back to 0, so nothing is shifted or copied on every frame. When the free space
+    at the end runs out, the unread tail (normally a partial frame) wraps back to the start of the buffer.
+    """
+
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __bytes__(self):
+        return bytes(self.view[self.start:self.end])
+
+    def reserve(self, n_bytes):
+        """Make sure at least n_bytes can be written after end"""
+        if len(self.buffer) - self.end >= n_bytes:
+            return
+        unread = self.end - self.start
+        if len(self.buffer) - unread >= n_bytes:
+            self.view[:unread] = self.view[self.start:self.end]
+        else:
+            # A frame larger than the buffer: grow it. Memoryviews handed out before keep the old buffer alive.
+            buffer = bytearray(max(2 * len(self.buffer), unread + n_bytes))
+            buffer[:unread] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = unread
+
+    def write_view(self, n_bytes):
+        """Memoryview of n_bytes of free space after end, call advance with the number of bytes written in it"""
+        self.reserve(n_bytes)
+        return self.view[self.end:self.end + n_bytes]
+
+    def advance(self, n_bytes):
+        self.end += n_bytes
+
+    def recv_into(self, sock, n_bytes):
+        """Receive up to n_bytes from sock directly into the buffer
+
+        :return: number of bytes received, 0 when the connection is closed
+        """
+        received = sock.recv_into(self.write_view(n_bytes), n_bytes)
+        self.end += received
+        return received
+
+    def extend(self, data):
+        """Copy data into the buffer, for data that does not come straight from a socket"""
+        self.reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def consume(self, n_bytes):
+        self.start += n_bytes
+        if self.start >= self.end:
+            self.clear()
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+
+
 class ethernet_table:
+    # Parsed table files by path: [modification time, state], a file is only parsed again when it changes
+    loaded = {}
+
     def __init__(self, filename: str):
         self.state = {"Robot_Link": ["?", False],
                       "Current_Time": ["s", "2099-06-25T15:45:30.123"],
@@ -136,198 +316,1144 @@ class ethernet_table:
         self.load_ethernet_table()
 
     def load_ethernet_table(self):
-        while True:
+        """Load the table file, created with the default items when it does not exist"""
+        path = f"{self.dir}{self.filename}"
+        try:
+            modified = os.path.getmtime(path)
+        except FileNotFoundError:
+            log.info(f"Creating the ethernet table {path}")
+            self.save_ethernet_table()
+            return
+        loaded = ethernet_table.loaded.get(path)
+        if loaded is None or loaded[0] != modified:
+            with open(path) as file:
+                loaded = [modified, json.load(file)]
+            ethernet_table.loaded[path] = loaded
+        self.state = {item_name: list(entry) for item_name, entry in loaded[1].items()} | self.state
+
+    def save_ethernet_table(self, exclude=()):
+        """:param exclude: names of the items left out of the file"""
+        path = f"{self.dir}{self.filename}"
+        state = {item_name: entry for item_name, entry in self.state.items() if item_name not in exclude}
+        with open(path, 'w') as file:
+            json.dump(state, file)
+        # What was just written does not need to be parsed again
+        ethernet_table.loaded[path] = [os.path.getmtime(path), {item_name: list(entry)
+                                                                for item_name, entry in state.items()}]
+        log.info(f"Ethernet table saved as {path}")
+
+
+class SchemaCache:
+    """Item types and decode plans of the Ethernet Slave layouts seen before.
+
+    A layout is keyed by a hash of its list of (item name, size), so a TMSVR connecting (or reconnecting) to a
+    robot whose table was seen before takes the item types and the compiled DecodePlan from here, without
+    inferring types or compiling anything. The types are also saved, one small file per hash in dir, so a new
+    process starts without inferring them again.
+    """
+    dir = "ethernet_tables/schemas/"
+    types = {}
+    plans = {}
+
+    @classmethod
+    def load_types(cls, key):
+        """Types of the layout, from this process or from its file, None for a layout never seen"""
+        types = cls.types.get(key)
+        if types is None:
             try:
-                self.state = json.load(open(f"{self.dir}{self.filename}")) | self.state
-                return
+                with open(f"{cls.dir}{key}.json") as file:
+                    types = cls.types[key] = json.load(file)
             except FileNotFoundError:
-                ans = input(
-                    f"Could not find the ethernet table file named {self.filename}. Create {self.filename} file? y/n")
-                if ans.lower() == 'y':
-                    json.dump(self.state, open(f"{self.dir}{self.filename}", 'w'))
-                    return
-                else:
-                    self.filename = input("Enter the filename of the ethernet table: ").strip(".json") + ".json"
+                return None
+            except ValueError as e:
+                log.warning(f"Schema cache {key} ignored: {e}")
+                return None
+        return types
+
+    @classmethod
+    def save_types(cls, key, types):
+        cls.types[key] = types
+        os.makedirs(cls.dir, exist_ok=True)
+        with open(f"{cls.dir}{key}.json", 'w') as file:
+            json.dump(types, file)
 
-    def save_ethernet_table(self):
-        while True:
-            ans = input(f"Save the new ethernet table as {self.filename}? y/n")
-            if ans.lower().strip(" ") == 'y':
-                json.dump(self.state, open(f"{self.dir}{self.filename}", 'w'))
-                print("Ethernet table saved")
-                return
+    @staticmethod
+    def key(items):
+        return hashlib.blake2b(repr(list(items)).encode('utf-8'), digest_size=16).hexdigest()
+
+    @classmethod
+    def plan(cls, key, items, state, decode_items=None):
+        """DecodePlan of the layout, compiled the first time it is asked for these types and decoded items"""
+        plan_key = (key, tuple(state[item_name][0] if item_name in state else None for item_name, size in items),
+                    frozenset(decode_items) if decode_items is not None else None)
+        plan = cls.plans.get(plan_key)
+        if plan is None:
+            plan = cls.plans[plan_key] = DecodePlan(items, state, decode_items)
+        return plan
+
+
+class DecodePlan:
+    """Decoder compiled from the layout of a binary (mode 1) Ethernet Slave frame.
+
+    The layout (item names and value sizes) only changes when the table on the robot changes, so the whole
+    content block, name and length fields included, is described by a single little endian struct.Struct.
+    decode() unpacks a frame in one call and checks that the name and length fields still match the layout
+    the plan was compiled from. Items left out of decode_items are skipped as pad bytes, their position in
+    the content block is kept in self.lazy so they can be decoded later on demand.
+    """
+
+    def __init__(self, items, state, decode_items=None):
+        """
+        :param items: list of (item name, value size in bytes) in the order they are received
+        :param state: ethernet table state, provides the data type of each item
+        :param decode_items: names of the items to unpack on every frame, None to unpack all of them
+        :raises ValueError: if an item has an unknown data type or a size that does not fit it
+        """
+        fmt = ['<']
+        layout_indices = []
+        layout = []
+        self.fields = []
+        self.lazy = {}
+        index = 0
+        offset = 0
+        for item_name, size in items:
+            name = item_name.encode('utf-8')
+            fmt.append(f'H{len(name)}sH')
+            layout_indices.extend((index, index + 1, index + 2))
+            layout.extend((len(name), name, size))
+            index += 3
+            offset += len(name) + 4
+
+            data_type = state[item_name][0] if item_name in state else None
+            if data_type == 's':
+                value_fmt = f'{size}s'
+                count = 1
+            elif data_type == '?' and size == 1:
+                value_fmt = '?'
+                count = 1
+            elif data_type in ('f', 'i') and size and size % 4 == 0:
+                count = size // 4
+                value_fmt = f'{count}{data_type}'
             else:
-                self.filename = input("Enter the new name for the table file: ").strip(".json") + ".json"
+                raise ValueError(f"Cannot compile item {item_name} of type {data_type} ({size} bytes)")
 
+            if decode_items is None or item_name in decode_items:
+                fmt.append(value_fmt)
+                # A single value is stored as a scalar, more than one as a list, like TMSVR.decoder does
+                self.fields.append((item_name, data_type, index, index + count, count != 1))
+                index += count
+            else:
+                fmt.append(f'{size}x')
+                self.lazy[item_name] = (data_type, offset, offset + size)
+            offset += size
+
+        self.struct = struct.Struct(''.join(fmt))
+        self.layout_getter = operator.itemgetter(*layout_indices)
+        self.layout = tuple(layout)
+
+    def decode(self, content):
+        """Unpack a content block with the compiled layout
+
+        :param content: content of the data block, after the transaction ID and the mode
+        :return: tuple of unpacked fields, index them with self.fields, or None if the layout does not match
+        """
+        if len(content) != self.struct.size:
+            return None
+        values = self.struct.unpack(content)
+        if self.layout_getter(values) != self.layout:
+            return None
+        return values
+
+
+class StateSnapshot:
+    """Immutable, frame consistent view of the Ethernet Slave items.
+
+    TMSVR publishes a new snapshot after every frame by replacing a single reference, so a reader that holds
+    a snapshot sees every item from the same frame without taking a lock. Array values are tuples. Items that
+    are not subscribed are decoded from the raw bytes of the snapshot's own frame when first read.
+    """
+    __slots__ = ('frame', 'values', 'raw', 'lazy', 'lazy_values')
+
+    def __init__(self, frame, values, raw=None, lazy=None):
+        """
+        :param frame: number of the frame the values come from
+        :param values: dict of item name -> decoded value, owned by the snapshot from now on
+        :param raw: content bytes of the frame, for the lazy items
+        :param lazy: DecodePlan.lazy of the plan that decoded the frame
+        """
+        self.frame = frame
+        self.values = values
+        self.raw = raw
+        self.lazy = lazy if raw is not None and lazy else {}
+        self.lazy_values = {}
+
+    @classmethod
+    def from_state(cls, frame, state):
+        return cls(frame, {item_name: tuple(value) if isinstance(value, list) else value
+                           for item_name, (data_type, value) in state.items()})
+
+    def __getitem__(self, item_name):
+        if item_name in self.lazy:
+            if item_name not in self.lazy_values:
+                data_type, first, last = self.lazy[item_name]
+                value = TMSVR.decode_value(data_type, memoryview(self.raw)[first:last])
+                self.lazy_values[item_name] = tuple(value) if isinstance(value, list) else value
+            return self.lazy_values[item_name]
+        return self.values[item_name]
+
+    def __contains__(self, item_name):
+        return item_name in self.values or item_name in self.lazy
+
+    def get(self, item_name, default=None):
+        return self[item_name] if item_name in self else default
+
+    def raw_item(self, item_name):
+        """Memoryview of the raw value of an item that is not subscribed, None if it was decoded with the frame"""
+        if item_name not in self.lazy:
+            return None
+        data_type, first, last = self.lazy[item_name]
+        return memoryview(self.raw)[first:last]
+
+
+class StateHistory:
+    """Fixed capacity history of numeric Ethernet Slave items in preallocated NumPy arrays.
+
+    Every sample is written in place into a row of the arrays (wrapping around when the capacity is reached),
+    so appending allocates nothing that outlives the call. Queries return the samples in chronological order.
+    Time stamps are time.time() at the moment the frame was parsed.
+    """
+
+    def __init__(self, items, capacity=10000):
+        """
+        :param items: dict of item name -> number of values of the item (1 for scalars)
+        :param capacity: number of samples kept, the oldest ones are overwritten
+        """
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.columns = {item_name: np.zeros(capacity) if width == 1 else np.zeros((capacity, width))
+                        for item_name, width in items.items()}
+        # Total number of samples written, the next one goes to row count % capacity
+        self.count = 0
+
+    def append(self, timestamp, snapshot):
+        row = self.count % self.capacity
+        self.times[row] = timestamp
+        for item_name, column in self.columns.items():
+            column[row] = snapshot[item_name]
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def rows(self, n=None):
+        """Indices of the last n samples (all of them if n is None) in chronological order"""
+        count = self.count
+        n = min(count, self.capacity) if n is None else min(n, count, self.capacity)
+        return np.arange(count - n, count) % self.capacity
+
+    def last(self, n, item_name=None):
+        """Last n samples of an item, or (times, {item name: samples}) for every item if item_name is None"""
+        rows = self.rows(n)
+        if item_name is not None:
+            return self.columns[item_name][rows]
+        return self.times[rows], {name: column[rows] for name, column in self.columns.items()}
+
+    def since(self, timestamp, item_name=None):
+        """Samples taken at or after timestamp, same return values as last"""
+        rows = self.rows()
+        n = len(rows) - np.searchsorted(self.times[rows], timestamp)
+        return self.last(n, item_name)
+
+    def window(self, item_name, n=None, since=None):
+        """Samples of an item over the last n samples or since a timestamp, the whole history if both are None"""
+        if since is not None:
+            return self.since(since, item_name)
+        return self.last(n if n is not None else self.capacity, item_name)
+
+    def window_mean(self, item_name, n=None, since=None):
+        return self.window(item_name, n, since).mean(axis=0)
+
+    def window_max(self, item_name, n=None, since=None):
+        return self.window(item_name, n, since).max(axis=0)
+
+    def window_min(self, item_name, n=None, since=None):
+        return self.window(item_name, n, since).min(axis=0)
+
+
+class CsvLogWriter:
+    """Log sink writing the items of every record as a CSV row, arrays flattened"""
+
+    def __init__(self, filename, items, mode='a'):
+        self.file = open(filename, mode, newline='', buffering=1 << 20)
+        self.writer = csv.writer(self.file)
+        self.items = items
+        self.rows = []
+
+    def write(self, timestamp, snapshot):
+        row = []
+        for item in self.items:
+            var = snapshot[item]
+            if isinstance(var, tuple):
+                row.extend(var)
+            else:
+                row.append(var)
+        self.rows.append(row)
 
-class TMSVR(TMPacket):
+    def flush(self):
+        self.writer.writerows(self.rows)
+        self.rows.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class LogWriterThread:
+    """Writes log records on a dedicated thread, so the receive loop never waits for the disk.
+
+    Records go through a bounded queue: submit() never blocks, when the queue is full the record is dropped and
+    counted. The thread drains the queue in batches and flushes the sink (CsvLogWriter or BinaryLogWriter) every
+    flush_records records or flush_interval seconds, whichever comes first. A record the sink fails to write is
+    counted in errors and skipped, the thread keeps running.
+    """
+
+    def __init__(self, sink, max_queue=10000, flush_records=1000, flush_interval=1.0):
+        self.sink = sink
+        self.queue = queue.Queue(max_queue)
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        # Number of times the queue filled up, each one can drop many records
+        self.overflows = 0
+        self.overflowing = False
+        self.high_water = 0
+        self.flushes = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, timestamp, snapshot):
+        """Queue a record, StateSnapshots are immutable so they are queued without copying
+
+        :return: False if the record was dropped because the queue is full
+        """
+        try:
+            self.queue.put_nowait((timestamp, snapshot))
+        except queue.Full:
+            self.dropped += 1
+            if not self.overflowing:
+                self.overflowing = True
+                self.overflows += 1
+            return False
+        self.overflowing = False
+        self.submitted += 1
+        depth = self.queue.qsize()
+        if depth > self.high_water:
+            self.high_water = depth
+        return True
+
+    def run(self):
+        pending = 0
+        last_flush = time.monotonic()
+        running = True
+        while running:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+                while record is not None:
+                    try:
+                        self.sink.write(*record)
+                        pending += 1
+                    except Exception as e:
+                        self.write_failed(e)
+                    if pending >= self.flush_records:
+                        break
+                    record = self.queue.get_nowait()
+                else:
+                    running = False
+            except queue.Empty:
+                pass
+            if pending and (not running or pending >= self.flush_records
+                            or time.monotonic() - last_flush >= self.flush_interval):
+                try:
+                    self.sink.flush()
+                    self.written += pending
+                    self.flushes += 1
+                except Exception as e:
+                    self.write_failed(e)
+                pending = 0
+                last_flush = time.monotonic()
+        try:
+            self.sink.close()
+        except Exception as e:
+            self.write_failed(e)
+
+    def write_failed(self, error):
+        # Only the first error is logged, a bad column fails every record
+        if not self.errors:
+            log.error(f"Log writer failed: {error!r}")
+        self.errors += 1
+
+    def stats(self):
+        return {"submitted": self.submitted, "written": self.written, "dropped": self.dropped,
+                "overflows": self.overflows, "queued": self.queue.qsize(), "high_water": self.high_water,
+                "flushes": self.flushes, "errors": self.errors}
+
+    def close(self, timeout=None):
+        """Write everything still queued, close the sink and stop the thread
+
+        :param timeout: seconds to wait for the thread, None waits until everything is written
+        :return: False if the thread is still writing after timeout
+        """
+        while self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+
+class RobotClock:
+    """Robot clock tracked from the Current_Time item of the Ethernet Slave frames.
+
+    Current_Time has a fixed layout (2024-06-25T15:45:30.123), so only the date needs datetime and it is cached:
+    the time of day is read from fixed positions. The interval between frames is kept in a preallocated ring of
+    integer microseconds, from which stats() computes the jitter and the number of missed frames.
+    """
+    EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, capacity=10000):
+        self.date_prefix = None
+        self.date_us = 0
+        self.last_us = None
+        self.dt_us = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+
+    def parse(self, timestamp):
+        """Microseconds since the epoch of a Current_Time value"""
+        date = timestamp[:10]
+        if date != self.date_prefix:
+            self.date_us = (datetime.strptime(date, "%Y-%m-%d") - RobotClock.EPOCH) // timedelta(microseconds=1)
+            self.date_prefix = date
+        fraction = timestamp[20:]
+        seconds = int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + int(timestamp[17:19])
+        return self.date_us + seconds * 1000000 + int(fraction) * 10 ** (6 - len(fraction))
+
+    def update(self, timestamp):
+        """Add the Current_Time of a new frame
+
+        :return: time since the previous frame in milliseconds, 0 for the first frame or if the clock went back
+        """
+        now = self.parse(timestamp)
+        last = self.last_us
+        self.last_us = now
+        if last is None:
+            return 0
+        dt = now - last
+        self.dt_us[self.count % len(self.dt_us)] = dt
+        self.count += 1
+        return dt / 1000 if dt > 0 else 0
+
+    def series(self, n=None):
+        """Last n intervals between frames in microseconds, in chronological order"""
+        count = self.count
+        n = min(count, len(self.dt_us)) if n is None else min(n, count, len(self.dt_us))
+        return self.dt_us[np.arange(count - n, count) % len(self.dt_us)]
+
+    def stats(self, n=None, period_ms=None):
+        """Jitter and missed frames of the robot clock over the last n intervals
+
+        :param n: number of intervals, all the ones kept if None
+        :param period_ms: nominal period of the Ethernet Slave, the median interval if None
+        :return: dict with the nominal period, mean, standard deviation (jitter), min and max interval in
+        milliseconds, the largest deviation from the period, and the number of frames missed
+        """
+        dt = self.series(n)
+        if not len(dt):
+            return None
+        period = period_ms * 1000 if period_ms is not None else float(np.median(dt))
+        missed = np.rint(dt / period).astype(np.int64) - 1 if period > 0 else np.zeros(len(dt), dtype=np.int64)
+        return {"intervals": len(dt),
+                "period_ms": period / 1000,
+                "mean_ms": float(dt.mean()) / 1000,
+                "jitter_ms": float(dt.std()) / 1000,
+                "min_ms": int(dt.min()) / 1000,
+                "max_ms": int(dt.max()) / 1000,
+                "max_deviation_ms": float(np.abs(dt - period).max()) / 1000,
+                "missed_frames": int(missed[missed > 0].sum()),
+                "repeated_frames": int((dt <= 0).sum())}
 
-    def __init__(self, ip, table_name="Default.json"):
+
+class TMSVR(TMPacket):
+    # Codes of the server responses (mode 0)
+    RESPONSE_CODES = {"00": "OK", "01": "NotSupport", "02": "WritePermission", "03": "InvalidData",
+                      "04": "NotExist", "05": "ReadOnly", "06": "ModeError", "07": "ValueError"}
+    # Data modes of the stream, as set in the Ethernet Slave settings of TMflow
+    DATA_MODES = {"binary": "1", "string": "2", "json": "3"}
+    # A number of a string (mode 2) frame, and the elements of an array {..} (strings are quoted)
+    STRING_NUMBER = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+    STRING_ELEMENT = re.compile(r'"[^"]*"|[^,]+')
+    JSON_ITEM = operator.itemgetter("Item", "Value")
+    # Types of the items of the TMflow Ethernet Slave list, the others are inferred from their values
+    KNOWN_ITEM_TYPES = {
+        "Robot_Link": "?", "Robot_Error": "?", "Project_Run": "?", "Project_Pause": "?", "Safeguard_A": "?",
+        "ESTOP": "?", "Camera_Light": "?", "Error_Code": "i", "Project_Speed": "i", "MA_Mode": "i",
+        "Robot_Light": "i", "Current_Time": "s", "Robot_Model": "s", "Project_Name": "s", "Error_Content": "s",
+        "Error_Time": "s", "Joint_Angle": "f", "Joint_Speed": "f", "Joint_Torque": "f", "Joint_Torque_Average": "f",
+        "Joint_Torque_Min": "f", "Joint_Torque_Max": "f", "Coord_Base_Flange": "f", "Coord_Robot_Flange": "f",
+        "Coord_Base_Tool": "f", "Coord_Robot_Tool": "f", "TCP_Force": "f", "TCP_Force3D": "f", "TCP_Speed": "f",
+        "TCP_Speed3D": "f", "TCP_Value": "f", "TCP_Mass": "f", "TCP_MCF": "f", "Base_Value": "f"}
+    KNOWN_PREFIX_TYPES = (("Ctrl_DO", "?"), ("Ctrl_DI", "?"), ("End_DO", "?"), ("End_DI", "?"),
+                          ("Ctrl_AO", "f"), ("Ctrl_AI", "f"), ("End_AO", "f"), ("End_AI", "f"))
+
+    def __init__(self, ip, table_name="Default.json", engine=None, data_mode=None):
+        """
+        :param ip: IP of the robot
+        :param table_name: name of the ethernet table
+        :param engine: IOEngine serving the socket, None to update the state with a thread of its own
+        :param data_mode: "binary", "string" or "json" as configured on the robot, None to take it from the first
+            frame
+        """
         super().__init__()
 
         self.buffer_size = 2048
-        self.data = bytearray(b'')
+        self.data = RingBuffer()
+        self.ip = ip
+        self.engine = engine
+        self.data_mode = self.DATA_MODES[data_mode] if data_mode is not None else None
+        self.init_requests()
+        # Seconds from connecting to the first decoded frame, set by frame_decoded
+        self.started = time.perf_counter()
+        self.first_frame_latency = None
 
         # For reading the ethernet table
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((ip, 5891))
-        self.recv()
+        self.read_first_frame()
         self.table = ethernet_table(table_name)
         self.state = self.table.state
+        self.received_items = []
+        # Items whose type was guessed from values that fit more than one type, see confirm_types
+        self.guessed_types = {}
         self.check_ethernet_items()
+        self.init_state()
 
-        self.data_length = len(self.data)
+        self.data_length = 0
 
         # For updating the state with a thread
         self.updating = True
         self.my_event = threading.Event()
         self.state_update_thread = None
-        self.start_update()
+        self.open_stream()
+
+    def read_first_frame(self):
+        """Receive until a frame of the stream (not a write response) is in data_block"""
+        while True:
+            while not self.deserialize():
+                if not self.recv():
+                    raise ConnectionError("Ethernet Slave connection closed before the first frame")
+            if not self.is_response(*self.split_data_block()[:2]):
+                return
+
+    def open_stream(self):
+        """Start decoding the stream, with the IOEngine or a thread of its own"""
+        if self.engine is not None:
+            self.clear()
+            self.connection = self.engine.add_packet(self, f"{self.ip}:5891")
+        else:
+            self.start_update()
+
+    def reconnect(self, timeout=5):
+        """Open a new connection after the link dropped and check the table again.
+
+        The table, subscriptions, history, clock and logging are kept, the decode plan is compiled again in case
+        the items of the Ethernet Slave changed.
+        """
+        if self.connection is not None:
+            # The old connection shares self.data, it must be done with it before the new one starts
+            self.connection.close_wait(timeout)
+            self.connection = None
+        else:
+            self.my_event.set()
+            self.updating = False
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            if self.state_update_thread is not None and self.state_update_thread is not threading.current_thread():
+                self.state_update_thread.join(timeout)
+        self.data.clear()
+        self.started = time.perf_counter()
+        self.first_frame_latency = None
+        self.sock = socket.create_connection((self.ip, 5891), timeout)
+        self.read_first_frame()
+        self.check_ethernet_items()
+        self.decode_plan = self.compile_decode_plan()
+        self.sock.settimeout(None)
+        self.my_event = threading.Event()
+        self.updating = True
+        self.open_stream()
+
+    def init_state(self):
+        """Set up decoding, snapshots and logging once the table of the first frame has been checked"""
+        # Items decoded on every frame, all of them while nobody subscribed
+        self.subscriptions = set()
+        self.layout_listeners = []
+        self.layout_changes = 0
+        # Frames whose items could not be read, they are skipped
+        self.bad_frames = 0
+        self.frame_count = 0
+        # Frames whose data mode is not the one of the connection, they are skipped
+        self.mode_mismatches = 0
+        self.clock = RobotClock()
+        self.decode_plan = self.compile_decode_plan()
+        # Replaced (never modified) after every frame, read it once and use that object for a consistent view
+        self.snapshot = StateSnapshot.from_state(self.frame_count, self.state)
+        self.history = None
 
         # For writing data to a file
         self.logging = False
         self.file_name = "temp_log.txt"
         self.file = None
+        self.log_writer = None
         self.items = ["Current_Time"]
 
-
     def get_received_table_items(self):
         self.deserialize()
+        return self.read_table_items()
+
+    def read_table_items(self):
+        """Names and sizes of the items in the frame held in data_block, None if it is a write response
+
+        The data mode of the connection is taken from this frame if it was not given. The sizes of the items of
+        a string or JSON frame are the sizes their values would have in a binary frame.
+        """
+        transaction_id, mode, content = self.split_data_block()
+        if self.is_response(transaction_id, mode):
+            return
+        if self.data_mode is None:
+            self.data_mode = mode
+        if mode != self.data_mode:
+            raise ValueError(f"Ethernet Slave frame in data mode {mode}, the connection expects {self.data_mode}")
+
         item_names = []
         item_sizes = []
-        max_indx = len(self.data_block)
-        index = 0
-        # Find ID
-        while index < max_indx:
-            if bytes([self.data_block[index]]) == TMPacket.P_SEPR:
-                break
-            index += 1
+        if mode == "1":
+            items = ((item_name, len(value)) for item_name, value in self.iter_items(content))
+        else:
+            values = self.decode_text(mode, content, self.state)
+            items = ((item_name, self.binary_size(value)) for item_name, value in values.items())
+        for item_name, size in items:
+            item_names.append(item_name)
+            item_sizes.append(size)
+        self.received_items = list(zip(item_names, item_sizes))
+        # Signature of the layout of a string or JSON frame, its sizes change with the values
+        self.received_names = tuple(item_names)
+        return item_names, item_sizes
 
-        if (self.data_block[:index].decode('utf-8') == "svr"):
-            return
+    @staticmethod
+    def binary_size(value):
+        """Size in bytes of a value decoded from a string or JSON frame in a binary frame"""
+        if isinstance(value, str):
+            return len(value.encode('utf-8'))
+        if isinstance(value, list):
+            return 4 * len(value)
+        return 1 if isinstance(value, bool) else 4
+
+    @classmethod
+    def decode_text(cls, mode, content, state=None):
+        """Decode the content of a string (2) or JSON (3) frame
+
+        The JSON list of {"Item", "Value"} is turned into a dict by mapping an itemgetter over it. The string
+        lines are split on their first '=', only {..} arrays, numbers and true/false are converted, any other
+        value is kept as its text.
+
+        :param state: state of the ethernet table, the items of type s are always kept as text
+        :return: dict item name: value, arrays as lists
+        :raises ValueError: the content is not valid
+        """
+        text = str(content, 'utf-8')
+        if mode == "3":
+            return dict(map(cls.JSON_ITEM, json.loads(text)))
+        values = {}
+        for line in text.splitlines():
+            item_name, separator, value = line.partition("=")
+            if not separator:
+                continue
+            data_type = state[item_name][0] if state is not None and item_name in state else \
+                cls.KNOWN_ITEM_TYPES.get(item_name)
+            if value.startswith("{") and value.endswith("}"):
+                values[item_name] = cls.string_array(value[1:-1], data_type)
+            else:
+                values[item_name] = cls.string_value(value, data_type)
+        return values
+
+    @classmethod
+    def string_array(cls, text, data_type=None):
+        """Elements of an array {..} of a string frame"""
+        if '"' not in text and data_type not in ("?", "s"):
+            # Arrays of numbers are converted in C, by float or by the JSON parser
+            try:
+                return list(map(float, text.split(","))) if data_type == "f" else json.loads(f"[{text}]")
+            except ValueError:
+                pass
+        return [cls.string_value(element, data_type) for element in cls.STRING_ELEMENT.findall(text)]
+
+    @classmethod
+    def string_value(cls, text, data_type=None):
+        """Value of one item (or array element) of a string frame"""
+        if len(text) > 1 and text[0] == text[-1] == '"':
+            return text[1:-1]
+        if data_type == "s":
+            return text
+        if text == "true" or text == "false":
+            return text == "true"
+        if cls.STRING_NUMBER.fullmatch(text):
+            if data_type == "f" or any(c in text for c in ".eE"):
+                return float(text)
+            return bool(int(text)) if data_type == "?" else int(text)
+        return text
+
+    def compile_decode_plan(self):
+        """Compile the DecodePlan for the items received in the first frame, None if the table cannot be compiled"""
+        if self.data_mode != "1":
+            # Text frames are decoded as a whole, see decode_text
+            return None
+        decode_items = None
+        if self.subscriptions:
+            # Current_Time is always decoded to keep dt up to date
+            decode_items = self.subscriptions | {"Current_Time"}
+        try:
+            return SchemaCache.plan(self.schema_key, self.received_items, self.state, decode_items)
+        except ValueError as e:
+            log.warning(f"Decoding the ethernet table item by item: {e}")
+            return None
 
-        index += 1
-        index_i = index
+    def check_ethernet_items(self):
+        """Add the received items missing from the ethernet table with an inferred type, see infer_type
+
+        The types of a layout seen before come from the SchemaCache, the table file is only written when items
+        were added. A type that is only a guess is used but neither saved nor cached until the values of the
+        next frames confirm it (self.guessed_types, see confirm_types).
+        """
+        self.read_table_items()
+        self.schema_key = SchemaCache.key(self.received_items)
+        types = SchemaCache.load_types(self.schema_key)
+        guessed = {}
+        if types is None:
+            values = None
+            types = {}
+            for item_name, size in self.received_items:
+                if item_name in self.state and item_name not in self.guessed_types:
+                    types[item_name] = self.state[item_name][0]
+                    continue
+                if values is None:
+                    values = self.received_values()
+                types[item_name], certain = self.infer_type(item_name, size, values.get(item_name))
+                if certain:
+                    log.info(f"Ethernet Slave item {item_name} ({size} bytes) added as type {types[item_name]}")
+                else:
+                    guessed[item_name] = types[item_name]
+                    log.warning(f"Ethernet Slave item {item_name} ({size} bytes) guessed as type "
+                                f"{types[item_name]}, it is saved once its values confirm it")
+            if not guessed:
+                SchemaCache.save_types(self.schema_key, types)
+        new_items = [item_name for item_name in types if item_name not in self.state or item_name in guessed
+                     or item_name in self.guessed_types]
+        for item_name in new_items:
+            self.state[item_name] = [types[item_name], None]
+        self.guessed_types = guessed
+        if any(item_name not in guessed for item_name in new_items):
+            self.table.save_ethernet_table(exclude=guessed)
+
+    def received_values(self):
+        """Values of the frame held in data_block: raw bytes for a binary frame, decoded for a string or JSON one"""
+        transaction_id, mode, content = self.split_data_block()
+        if mode == "1":
+            return {item_name: bytes(value) for item_name, value in self.iter_items(content)}
+        return self.decode_text(mode, content, self.state)
+
+    @classmethod
+    def infer_type(cls, item_name, size, value=None):
+        """Data type of an item missing from the ethernet table
+
+        The name decides for the items of the TMflow list, then the value: its JSON type in a string or JSON
+        frame, in a binary frame 1 byte is a boolean, printable text a string, and 4 byte words are told apart
+        by word_type. Words that fit both types (all zero, like a counter at 0) are only a guess.
+
+        :return: data type, and False when it is only a guess (see confirm_types)
+        """
+        if item_name in cls.KNOWN_ITEM_TYPES:
+            return cls.KNOWN_ITEM_TYPES[item_name], True
+        for prefix, data_type in cls.KNOWN_PREFIX_TYPES:
+            if item_name.startswith(prefix) and (data_type != "?" or size == 1):
+                return data_type, True
+        if isinstance(value, list):
+            # {1,2,0.5} in a string frame is a float array
+            value = next((element for element in value if isinstance(element, float)), value[0] if value else 0.0)
+        if isinstance(value, bool):
+            return "?", True
+        if isinstance(value, int):
+            return "i", True
+        if isinstance(value, float):
+            return "f", True
+        if isinstance(value, str):
+            return "s", True
+        if size == 1:
+            return "?", True
+        if value is not None and all(32 <= byte < 127 for byte in value):
+            return "s", True
+        if size % 4:
+            return "s", True
+        data_type = cls.word_type(value) if value is not None else None
+        return (data_type, True) if data_type is not None else ("f", False)
 
-        # Find Mode
-        while index < max_indx:
-            if bytes([self.data_block[index]]) == TMPacket.P_SEPR:
-                break
-            index += 1
+    @staticmethod
+    def word_type(value):
+        """Type of a value made of 4 byte words, None when its words fit both
+
+        Integers read as floats are NaN or denormal (a small integer like 1 is 1.4e-45 as a float), a float has
+        at least one word of a plausible magnitude. Zero words fit both.
+        """
+        data_type = None
+        for number in struct.unpack(f'<{len(value) // 4}f', value):
+            if number != number or (number != 0.0 and abs(number) < 1e-30):
+                return "i"
+            if 1e-6 <= abs(number) <= 1e9:
+                data_type = "f"
+        return data_type
+
+    def confirm_types(self, content):
+        """Check the values of the items whose type was only guessed, the type is saved once a value decides it"""
+        confirmed = {}
+        for item_name, value in self.iter_items(content):
+            if item_name in self.guessed_types:
+                data_type = self.word_type(value)
+                if data_type is not None:
+                    confirmed[item_name] = data_type
+        if not confirmed:
+            return
+        for item_name, data_type in confirmed.items():
+            del self.guessed_types[item_name]
+            if self.state[item_name][0] != data_type:
+                log.warning(f"Ethernet Slave item {item_name} is type {data_type}, not {self.state[item_name][0]}")
+                self.state[item_name] = [data_type, None]
+            else:
+                log.info(f"Ethernet Slave item {item_name} confirmed as type {data_type}")
+        self.decode_plan = self.compile_decode_plan()
+        if not self.guessed_types:
+            SchemaCache.save_types(self.schema_key, {item_name: self.state[item_name][0]
+                                                     for item_name, size in self.received_items})
+        self.table.save_ethernet_table(exclude=self.guessed_types)
 
-        index += 1
-        index_i = index
-        while index < max_indx:
-            index += 2
+    def send(self, item_name, value, script_id="svr"):
+        self.send_items({item_name: value}, script_id)
 
-            item_length = struct.unpack('<H', self.data_block[index_i:index])[0]
+    def send_items(self, items, script_id="svr"):
+        """Write several items with a single frame
 
-            index_i = index
-            index += item_length
-            item_name = self.data_block[index_i:index].decode('utf-8')
+        :param items: dict of item name: value, or a list of (item name, value)
+        """
+        self.write_frame(self.build_frame("TMSVR", self.write_items_data(items, script_id)))
 
-            index_i = index
-            index += 2
-            item_length = struct.unpack('<H', self.data_block[index_i:index])[0]
+    def send_acked(self, items, timeout=5.0):
+        """Write several items with a single frame and track the response of the robot
 
-            index += item_length
+        :param items: dict of item name: value, or a list of (item name, value)
+        :param timeout: seconds to wait for the response, the future fails with a TimeoutError after that
+        :return: future set to the response message once the values are written, an EthernetSlaveError when the
+            robot rejects them
+        """
+        transaction_id, future = self.add_request("w", timeout)
+        try:
+            self.send_items(items, transaction_id)
+        except BaseException:
+            self.pop_request(transaction_id)
+            raise
+        return future
+
+    def read_items(self, item_names, timeout=5.0, ttl=None):
+        """Read items on demand with one read request (mode 11), items missing from the Ethernet Slave table too
+
+        Values read less than ttl seconds ago are taken from the cache, the request only asks for the others and
+        is not sent at all when every value is cached.
+
+        :param item_names: names of the items to read
+        :param timeout: seconds to wait for the response
+        :param ttl: maximum age in seconds of a cached value, self.read_ttl by default, 0 to always ask the robot
+        :return: future of a dict item name: value, an EthernetSlaveError when the robot rejects the request
+        """
+        values, missing = self.cached_items(item_names, ttl)
+        future = self.new_future()
+        if not missing:
+            future.set_result(values)
+            return future
+        transaction_id, response = self.add_request("r", timeout)
+        try:
+            self.write_frame(self.build_frame("TMSVR", self.read_request_data(missing, transaction_id)))
+        except BaseException:
+            self.pop_request(transaction_id)
+            raise
+        response.add_done_callback(lambda r: self.read_done(r, future, values))
+        return future
+
+    def read_done(self, response, future, values):
+        if response.exception() is not None:
+            future.set_exception(response.exception())
+        else:
+            values.update(self.cache_items(response.result()))
+            future.set_result(values)
 
-            item_names.append(item_name)
-            item_sizes.append(item_length)
+    @staticmethod
+    def read_request_data(item_names, transaction_id):
+        """Data block of a binary read request (mode 11): the length (2 bytes little endian) and name of each item"""
+        names = [item_name.encode("utf-8") for item_name in item_names]
+        return f"{transaction_id},11,".encode("utf-8") + b''.join(struct.pack('<H', len(name)) + name
+                                                               for name in names)
+
+    def cached_items(self, item_names, ttl=None):
+        """Values of the read cache younger than ttl seconds
+
+        :return: dict of the cached values and list of the names to request
+        """
+        if ttl is None:
+            ttl = self.read_ttl
+        now = time.monotonic()
+        values = {}
+        missing = []
+        for item_name in item_names:
+            cached = self.read_cache.get(item_name)
+            if cached is not None and now - cached[0] < ttl:
+                values[item_name] = cached[1]
+            else:
+                missing.append(item_name)
+        return values, missing
+
+    def cache_items(self, values):
+        now = time.monotonic()
+        self.read_cache.update((item_name, (now, value)) for item_name, value in values.items())
+        return values
+
+    def decode_response_items(self, content):
+        """Decode the items of a read response (binary content) with the types of the ethernet table, the items
+        the table does not know are kept as bytes"""
+        values = {}
+        for item_name, value in self.iter_items(content):
+            data_type = self.state[item_name][0] if item_name in self.state else None
+            values[item_name] = self.decode_value(data_type, value) if data_type is not None else bytes(value)
+        return values
+
+    def init_requests(self):
+        # Requests waiting for a response, by transaction ID: [future, deadline]
+        self.requests = {}
+        self.request_lock = threading.Lock()
+        self.request_count = 0
+        # IDs of the requests that timed out, a late response must not be taken for a stream frame
+        self.expired_requests = set()
+        # Values of read_items: item name: (time.monotonic() of the response, value)
+        self.read_cache = {}
+        self.read_ttl = 0.5
+
+    def new_future(self):
+        return Future()
+
+    def add_request(self, prefix, timeout):
+        """Register a request under a new transaction ID (prefix and a counter, never a stream frame ID)
+
+        :return: transaction ID and future of the response
+        """
+        future = self.new_future()
+        with self.request_lock:
+            self.request_count += 1
+            transaction_id = f"{prefix}{self.request_count}"
+            self.requests[transaction_id] = [future, time.monotonic() + timeout if timeout is not None else None]
+        return transaction_id, future
+
+    def pop_request(self, transaction_id):
+        with self.request_lock:
+            request = self.requests.pop(transaction_id, None)
+        return request[0] if request is not None else None
+
+    def is_response(self, transaction_id, mode):
+        """True for a server response or a reply to a request, False for a frame of the stream"""
+        return (mode == "0" or transaction_id == "svr" or transaction_id in self.requests
+                or transaction_id in self.expired_requests)
+
+    def response_received(self, transaction_id, mode, content):
+        """Resolve the request answered by the frame in data_block"""
+        future = self.pop_request(transaction_id)
+        if future is None or future.done():
+            return
+        if mode == "11":
+            # The reply to a read request has the content of a binary (mode 1) frame
+            future.set_result(self.decode_response_items(content))
+            return
+        if mode != "0":
+            future.set_exception(EthernetSlaveError(transaction_id, mode, "Unexpected response mode"))
+            return
+        text = str(content, 'utf-8').strip()
+        code, message = text[:2], text[3:]
+        if code == "00":
+            future.set_result(message or "OK")
+        else:
+            future.set_exception(EthernetSlaveError(transaction_id, code, message))
+
+    def expire_requests(self):
+        """Fail the requests whose response did not arrive before their deadline"""
+        now = time.monotonic()
+        with self.request_lock:
+            expired = [transaction_id for transaction_id, (future, deadline) in self.requests.items()
+                       if deadline is not None and now >= deadline]
+            futures = [self.requests.pop(transaction_id)[0] for transaction_id in expired]
+            if len(self.expired_requests) > 1000:
+                self.expired_requests.clear()
+            self.expired_requests.update(expired)
+        for transaction_id, future in zip(expired, futures):
+            if not future.done():
+                future.set_exception(TimeoutError(f"No response to request {transaction_id}"))
+
+    def fail_requests(self, exc):
+        with self.request_lock:
+            futures = [future for future, deadline in self.requests.values()]
+            self.requests.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc or ConnectionError("Ethernet Slave connection closed"))
 
-            index_i = index
-        return item_names, item_sizes
+    @staticmethod
+    def write_data(item_name, value, script_id="svr"):
+        """Data block of a string mode (2) write of one item"""
+        return TMSVR.write_items_data({item_name: value}, script_id)
 
-    def check_ethernet_items(self):
-        new_items = False
-        received_table_names, received_item_sizes = self.get_received_table_items()
-        i = 0
-        for item in received_table_names:
-            if item not in self.state:
-                while True:
-                    d_type = input(f"Please enter the data type of the item {item} ({received_item_sizes[i]} bytes): \n"
-                                   "s - string\n"
-                                   "f - float\n"
-                                   "i - integer\n"
-                                   "? - boolean\n").lower().strip(" ")
-
-                    if d_type not in ['s', 'f', 'i', '?']:
-                        print("Invalid data type")
-                    else:
-                        self.state[item] = [d_type, None]
-                        break
-                new_items = True
-            i += 1
-        if new_items:
-            self.table.save_ethernet_table()
+    @staticmethod
+    def write_items_data(items, script_id="svr"):
+        """Data block of a string mode (2) write of several items, one item=value line each"""
+        if isinstance(items, dict):
+            items = items.items()
+        lines = "".join(f"{item_name}={TMSVR.format_value(value)}\r\n" for item_name, value in items)
+        return f"{script_id},2,{lines}".encode("utf-8")
 
-    def send(self, item_name, value, script_id="svr"):
-        script_data = script_id + ",2,"
-        if isinstance(value, list):
-            value_str = ""
-            for v in value:
-                value_str = value_str + f"{v},"
-            value_str = "{" + value_str[:-1] + "}"
-            script_data = script_data + f"{item_name}=" + value_str + "\r\n"
-        else:
-            script_data = script_data + f"{item_name}={value}\r\n"
-        # log.info(script_data)
-        data_length = len(script_data)
-        # Convert string to bytes
-        self.data_block = "TMSVR" + "," + str(data_length) + ',' + script_data + ','
-        data_msg = self.data_block.encode("utf-8")
-
-        csum = self.checksum_calc(data_msg)
-        msg = b'$' + data_msg + b'*' + csum + b'\r\n'
-        # print(msg)
-        self.sock.send(msg)
+    @staticmethod
+    def format_value(value):
+        """Value as written in a string mode assignment, arrays as {v1,v2,...}"""
+        if isinstance(value, (list, tuple)):
+            return "{" + ",".join(map(str, value)) + "}"
+        return str(value)
 
     def recv(self):
-        self.data += (bytearray(self.sock.recv(self.buffer_size)))
+        return self.data.recv_into(self.sock, self.buffer_size)
 
     def close(self):
+        if self.connection is not None:
+            if self.logging:
+                self.stop_logging()
+            self.connection.close()
+            return
         if self.updating:
             self.stop_update()
         time.sleep(1)
         self.sock.close()
 
+    def connection_closed(self, exc):
+        log.warning(f"Ethernet Slave connection closed: {exc}")
+        self.fail_requests(exc)
+
     def state_update(self):
         self.updating = True
         self.clear()
+        error = None
         while self.updating:
-            self.recv()
+            try:
+                if not self.recv():
+                    break
+            except OSError as e:
+                error = e
+                break
             while len(self.data) > self.data_length:
                 if self.deserialize():
                     self.parse_data()
-                    if self.logging:
-                        combined_list = []
-                        for item in self.items:
-                            var = self.state[item][1]
-                            if isinstance(var, list):
-                                combined_list.extend(var)
-                            else:
-                                combined_list.append(var)
-                        writer = csv.writer(self.file)
-                        writer.writerow(combined_list)
                 else:
                     break
             if self.my_event.is_set():
-                break
-
-    def start_logging(self, filename=None, items: list = None, mode='a'):
+                return
+        if not self.my_event.is_set():
+            self.updating = False
+            self.connection_closed(error)
+
+    def start_logging(self, filename=None, items: list = None, mode='a', binary=False, chunk_records=100000):
+        """Log the items of every frame to a file
+
+        :param filename: name of the log file
+        :param items: names of the items to log
+        :param mode: file mode of the CSV log
+        :param binary: write fixed width binary records (see tm_binary_log) instead of CSV rows, a time stamp
+        column is added and the file is split in chunks of chunk_records records
+        The rows are written by a LogWriterThread, see logging_stats for its counters
+        :param chunk_records: number of records per chunk of the binary log
+        :raises ValueError: an item is not in the ethernet table
+        """
+        if items is not None:
+            missing = [item_name for item_name in items if item_name not in self.state]
+            if missing:
+                raise ValueError(f"Items not in the ethernet table: {missing}")
         if filename is not None:
             self.file_name = filename
         if items is not None:
             self.items = items
-        self.file = open(self.file_name, mode, newline='')
+        if binary:
+            self.file = BinaryLogWriter(self.file_name, self.log_columns(self.items), chunk_records)
+        else:
+            self.file = CsvLogWriter(self.file_name, self.items, mode)
+        # The files are written by a separate thread, a slow disk cannot stall the socket reading
+        self.log_writer = LogWriterThread(self.file)
         self.logging = True
 
-    def stop_logging(self):
+    def stop_logging(self, wait=True):
+        """Stop logging, the records still queued are written before the file is closed
+
+        :param wait: False closes the file on a separate thread, for the receive thread which cannot wait for the disk
+        """
         self.logging = False
-        self.file.close()
+        if wait:
+            self.log_writer.close()
+        else:
+            threading.Thread(target=self.log_writer.close, name="log-close").start()
+
+    def logging_stats(self):
+        """Counters of the log writer: records submitted, written, dropped, queue overflows and depth"""
+        return self.log_writer.stats() if self.log_writer is not None else None
+
+    def log_columns(self, items):
+        """Binary log columns [name, NumPy dtype, shape] of the items, sized like the values received"""
+        sizes = dict(self.received_items)
+        snapshot = self.snapshot
+        columns = []
+        for item_name in items:
+            data_type = self.state[item_name][0]
+            value = snapshot.get(item_name)
+            if item_name == "dt":
+                # Computed by the RobotClock in milliseconds, not received
+                columns.append([item_name, '<f8', []])
+            elif data_type == 's':
+                size = sizes.get(item_name, len(value.encode('utf-8')) if isinstance(value, str) else 0)
+                columns.append([item_name, f'S{max(size, 1)}', []])
+            elif data_type in ('f', 'i', '?'):
+                if item_name in sizes:
+                    width = 1 if data_type == '?' else sizes[item_name] // 4
+                else:
+                    width = len(value) if isinstance(value, tuple) else 1
+                dtype = {'f': '<f4', 'i': '<i4', '?': '?'}[data_type]
+                columns.append([item_name, dtype, [width] if width != 1 else []])
+            else:
+                raise ValueError(f"Cannot log item {item_name} of type {data_type}")
+        return columns
 
     def start_update(self):
-        self.clear()
+        # The stale frames are drained by the thread itself, see clear
         self.state_update_thread = threading.Thread(target=self.state_update)
         self.state_update_thread.start()
 
@@ -337,75 +1463,300 @@ class TMSVR(TMPacket):
         self.my_event.set()
         self.updating = False
 
-    def clear(self):
-        while len(self.sock.recv(self.buffer_size)) == self.buffer_size:
-            pass
-        self.data = bytearray(b'')
+    def clear(self, budget=0.05):
+        """Drop the frames received before the stream is decoded, without blocking
 
-    def parse_data(self):
-        max_indx = len(self.data_block)
-        index = 0
-        # Find ID
-        while index < max_indx:
-            if bytes([self.data_block[index]]) == TMPacket.P_SEPR:
-                break
-            index += 1
+        The socket is drained with non-blocking reads for at most budget seconds. The complete frames are dropped
+        (responses to requests are still resolved), an incomplete frame at the end is kept so decoding goes on
+        from its '$' head.
 
-        if (self.data_block[:index].decode('utf-8') == "svr"):
-            return
-
-        index += 1
-
-        # Find Mode
-        while index < max_indx:
-            if bytes([self.data_block[index]]) == TMPacket.P_SEPR:
-                break
-            index += 1
+        :param budget: maximum seconds spent draining
+        """
+        deadline = time.perf_counter() + budget
+        timeout = self.sock.gettimeout()
+        self.sock.settimeout(0)
+        try:
+            while time.perf_counter() < deadline:
+                self.drop_frames()
+                try:
+                    if not self.data.recv_into(self.sock, 16 * self.buffer_size):
+                        break
+                except OSError:
+                    # Nothing more to read, or the connection dropped and the next recv reports it
+                    break
+        finally:
+            self.sock.settimeout(timeout)
+        self.drop_frames()
+
+    def drop_frames(self):
+        """Drop the complete frames in the receive buffer, except the responses to requests"""
+        ring = self.data
+        if not self.requests:
+            # No response to wait for, skip straight to the head of the last frame
+            head = ring.buffer.rfind(b'$TMSVR,', ring.start, ring.end)
+            if head < 0:
+                ring.clear()
+                return
+            ring.consume(head - ring.start)
+        while ring and self.deserialize():
+            transaction_id, mode, content = self.split_data_block()
+            if self.is_response(transaction_id, mode):
+                self.response_received(transaction_id, mode, content)
+
+    def split_data_block(self):
+        """Split the data block into transaction ID, mode and content
+
+        :return: transaction ID (str), mode (str) and content (memoryview)
+        """
+        block = self.data_block
+        max_indx = len(block)
+        separator = TMPacket.P_SEPR[0]
+        id_end = 0
+        while id_end < max_indx and block[id_end] != separator:
+            id_end += 1
+        mode_end = id_end + 1
+        while mode_end < max_indx and block[mode_end] != separator:
+            mode_end += 1
+        return str(block[:id_end], 'utf-8'), str(block[id_end + 1:mode_end], 'utf-8'), block[mode_end + 1:]
 
-        index += 1
-        index_i = index
+    @staticmethod
+    def iter_items(content):
+        """Yields (item name, value bytes) for each item of a binary content block"""
+        max_indx = len(content)
+        index = 0
         while index < max_indx:
+            name_length = struct.unpack_from('<H', content, index)[0]
             index += 2
-
-            item_length = struct.unpack('<H', self.data_block[index_i:index])[0]
-
-            index_i = index
-            index += item_length
-            item_name = self.data_block[index_i:index].decode('utf-8')
-
-            index_i = index
+            item_name = str(content[index:index + name_length], 'utf-8')
+            index += name_length
+            value_length = struct.unpack_from('<H', content, index)[0]
             index += 2
-            item_length = struct.unpack('<H', self.data_block[index_i:index])[0]
-
-            index_i = index
-            index += item_length
+            yield item_name, content[index:index + value_length]
+            index += value_length
 
-            self.decoder(item_name, self.data_block[index_i:index])
-            index_i = index
+    def parse_data(self):
+        transaction_id, mode, content = self.split_data_block()
+        if self.requests:
+            # The stream frames are the clock of the request deadlines
+            self.expire_requests()
+        if self.is_response(transaction_id, mode):
+            self.response_received(transaction_id, mode, content)
+            return
+        if mode != self.data_mode:
+            self.mode_mismatches += 1
+            return
 
-    @staticmethod
-    def dt_calc(time1, time2):
-        timestamp_format = "%Y-%m-%dT%H:%M:%S.%f"
-        dt1 = datetime.strptime(time1, timestamp_format)
-        dt2 = datetime.strptime(time2, timestamp_format)
-
-        # Calculate the difference between the two datetime objects
-        delta = dt2 - dt1
-        if delta.total_seconds() < 0:
-            # print("Time1 is greater than Time2")
-            return 0
+        if mode != "1":
+            try:
+                values = self.decode_text(mode, content, self.state)
+            except (ValueError, KeyError, TypeError) as e:
+                self.bad_frames += 1
+                log.warning(f"Ethernet Slave frame skipped: {e}")
+                return
+            if tuple(values) != self.received_names and not self.layout_changed():
+                return
+            self.frame_count += 1
+            self.publish(self.apply_values(values))
+            self.frame_decoded()
+            return
+        plan = self.decode_plan
+        # The plan checks the names and sizes of the frame against its layout in the same unpack
+        values = plan.decode(content) if plan is not None else None
+        if values is None and (plan is not None or self.frame_layout(content) != self.received_items):
+            if not self.layout_changed():
+                return
+            plan = self.decode_plan
+            values = plan.decode(content) if plan is not None else None
+        self.frame_count += 1
+        if values is not None:
+            decoded = self.apply_plan(plan, values)
+            # The content is a view of the receive buffer, the snapshot keeps a copy for the lazy items
+            raw = bytes(content) if plan.lazy else None
+            lazy = plan.lazy
         else:
-            # Convert the difference to milliseconds
-            return delta.total_seconds() * 1000
+            # Fallback for a layout the plan was not compiled for, every item is decoded
+            decoded = {}
+            for item_name, value in self.iter_items(content):
+                self.decoder(item_name, value)
+                value = self.state[item_name][1]
+                decoded[item_name] = tuple(value) if isinstance(value, list) else value
+            decoded["dt"] = self.state["dt"][1]
+            raw = None
+            lazy = None
+        self.publish(decoded, raw, lazy)
+        self.frame_decoded()
+        if self.guessed_types and self.frame_count % 10 == 0:
+            self.confirm_types(content)
+
+    def frame_layout(self, content):
+        """(item name, size) of the items of a binary content block"""
+        return [(item_name, len(value)) for item_name, value in self.iter_items(content)]
+
+    def layout_changed(self):
+        """The items of the frame in data_block are not the ones the decoder was set up for: the Ethernet Slave
+        table was edited on the robot. The new items are checked (types inferred, see check_ethernet_items), the
+        decode plan is compiled again and the layout listeners are called, the frame is then decoded with the new
+        plan. Items that are no longer received are dropped from the snapshot, history and logging are stopped
+        when their items changed (a listener can start them again).
+
+        :return: False if the items of the frame cannot be read or its checksum is wrong, the frame is skipped
+        """
+        if not self.checksum_ok:
+            # A corrupted frame, not an edited table
+            self.bad_frames += 1
+            log.warning("Ethernet Slave frame with a wrong checksum skipped")
+            return False
+        old_items = self.received_items
+        try:
+            self.check_ethernet_items()
+        except (struct.error, UnicodeDecodeError, ValueError) as e:
+            self.received_items = old_items
+            self.received_names = tuple(item_name for item_name, size in old_items)
+            self.bad_frames += 1
+            log.warning(f"Ethernet Slave frame skipped: {e}")
+            return False
+        if self.received_items == old_items:
+            return True
+        self.decode_plan = self.compile_decode_plan()
+        self.layout_changes += 1
+        # History and log have fixed columns, they are stopped when one of their items is gone or changed size
+        old_sizes = dict(old_items)
+        changed = {item_name for item_name, size in self.received_items if old_sizes.get(item_name, size) != size}
+        changed.update(old_sizes.keys() - set(self.received_names))
+        if self.history is not None and changed & self.history.columns.keys():
+            log.warning(f"History stopped, its items changed: {changed & self.history.columns.keys()}")
+            self.stop_history()
+        if self.logging and changed & set(self.items):
+            log.warning(f"Logging stopped, its items changed: {changed & set(self.items)}")
+            self.stop_logging(wait=False)
+        received = set(self.received_names) | {"dt"}
+        values = {item_name: value for item_name, value in self.snapshot.values.items() if item_name in received}
+        self.snapshot = StateSnapshot(self.snapshot.frame, values)
+        log.warning(f"Ethernet Slave table changed: {[item_name for item_name, size in self.received_items]}")
+        for callback in self.layout_listeners:
+            try:
+                callback(old_items, self.received_items)
+            except Exception as e:
+                log.error(f"Layout listener failed: {e}")
+        return True
 
-    def decoder(self, item_name, bytes_data):
-        data_type = self.state[item_name][0]
-        value = None
+    def add_layout_listener(self, callback):
+        """callback(old items, new items) is called from the receiving thread when the Ethernet Slave table changes,
+        items as lists of (item name, size)"""
+        self.layout_listeners.append(callback)
+
+    def frame_decoded(self):
+        """Keep the history and the log of the snapshot just published"""
+        if self.first_frame_latency is None:
+            self.first_frame_latency = time.perf_counter() - self.started
+            log.info(f"First Ethernet Slave frame decoded {1000 * self.first_frame_latency:.1f} ms after connecting")
+        if self.history is not None or self.logging:
+            timestamp = time.time()
+            if self.history is not None:
+                self.history.append(timestamp, self.snapshot)
+            if self.logging:
+                self.log_writer.submit(timestamp, self.snapshot)
+
+    def apply_plan(self, plan, values):
+        """Store the values unpacked by the decode plan in the state
+
+        :return: dict of the decoded items for the snapshot, array values as tuples
+        """
+        state = self.state
+        decoded = {}
+        for item_name, data_type, first, last, is_list in plan.fields:
+            if data_type == 's':
+                value = str(values[first], 'utf-8')
+                if item_name == "Current_Time":
+                    decoded["dt"] = state["dt"][1] = self.clock.update(value)
+                state[item_name][1] = value
+            elif is_list:
+                value = values[first:last]
+                state[item_name][1] = list(value)
+            else:
+                value = values[first]
+                state[item_name][1] = value
+            decoded[item_name] = value
+        return decoded
+
+    def apply_values(self, values):
+        """Store the values of a string or JSON frame in the state
+
+        :return: dict of the decoded items for the snapshot, array values as tuples
+        """
+        state = self.state
+        decoded = {}
+        for item_name, value in values.items():
+            if item_name in state:
+                state[item_name][1] = value
+            if isinstance(value, list):
+                value = tuple(value)
+            elif item_name == "Current_Time":
+                decoded["dt"] = state["dt"][1] = self.clock.update(value)
+            decoded[item_name] = value
+        return decoded
+
+    def publish(self, decoded, raw=None, lazy=None):
+        """Publish the snapshot of the frame just parsed, items missing from the frame keep their last value"""
+        values = dict(self.snapshot.values)
+        values.update(decoded)
+        self.snapshot = StateSnapshot(self.frame_count, values, raw, lazy)
+
+    def subscribe(self, *item_names):
+        """Decode only the subscribed items on every frame.
+
+        The other items of the table are kept as raw bytes of the last frame and only decoded when they are
+        read with get(). Until something is subscribed every item is decoded on every frame.
+        """
+        self.subscriptions.update(item_names)
+        self.decode_plan = self.compile_decode_plan()
+
+    def unsubscribe(self, *item_names):
+        self.subscriptions.difference_update(item_names)
+        self.decode_plan = self.compile_decode_plan()
+
+    def raw_item(self, item_name):
+        """Memoryview of the raw value of an item that is not subscribed, None if it is decoded on every frame"""
+        return self.snapshot.raw_item(item_name)
+
+    def clock_stats(self, n=None, period_ms=None):
+        """Jitter and missed frames of the robot clock, see RobotClock.stats"""
+        return self.clock.stats(n, period_ms)
+
+    def start_history(self, items: list = None, capacity=10000):
+        """Keep the last capacity samples of numeric items in a StateHistory, available as self.history
+
+        :param items: names of the items to keep, Joint_Angle, Coord_Base_Tool and dt by default
+        :param capacity: number of samples kept
+        """
+        if items is None:
+            items = ["Joint_Angle", "Coord_Base_Tool", "dt"]
+        snapshot = self.snapshot
+        widths = {}
+        for item_name in items:
+            if self.state[item_name][0] not in ('f', 'i', '?'):
+                raise ValueError(f"Item {item_name} is not numeric")
+            value = snapshot.get(item_name)
+            widths[item_name] = len(value) if isinstance(value, tuple) else 1
+        self.history = StateHistory(widths, capacity)
+        return self.history
+
+    def stop_history(self):
+        self.history = None
+
+    def get(self, item_name):
+        """Current value of an item, decoding it from the last frame if it is not subscribed"""
+        snapshot = self.snapshot
+        if item_name in snapshot.lazy:
+            value = snapshot[item_name]
+            self.state[item_name][1] = list(value) if isinstance(value, tuple) else value
+        return self.state[item_name][1]
 
+    @staticmethod
+    def decode_value(data_type, bytes_data):
+        value = None
         if data_type == 's':
-            value = bytes_data.decode('utf-8')
-            if item_name == "Current_Time":
-                self.state["dt"][1] = self.dt_calc(self.state["Current_Time"][1], value)
+            value = str(bytes_data, 'utf-8')
         elif data_type == '?':
             value = struct.unpack('?', bytes_data)[0]
         elif data_type == 'f':
@@ -422,83 +1773,735 @@ class TMSVR(TMPacket):
                 value = struct.unpack('i', bytes_data)[0]
         else:
             print("Unknown data type")
+        return value
 
+    def decoder(self, item_name, bytes_data):
+        data_type = self.state[item_name][0]
+        value = self.decode_value(data_type, bytes_data)
+        if item_name == "Current_Time":
+            self.state["dt"][1] = self.clock.update(value)
         self.state[item_name][1] = value
 
 
+class CoalescingWriter:
+    """Writes Ethernet Slave items at a fixed rate, the latest value of each item wins.
+
+    set() only stores the value, a thread sends every item set since the last tick in one TMSVR frame every
+    1 / rate seconds. A value replaced before it was sent is never written and is counted as merged, so a
+    writer faster than the rate cannot flood the socket with stale values. With ack the frames are sent with
+    TMSVR.send_acked and self.landed keeps the last value of each item confirmed by the robot.
+
+    Usage:
+        writer = CoalescingWriter(robot.TMSVR, rate=50)
+        writer.set("g_speed", 0.5)
+        writer.update({"g_x": 1.0, "g_y": 2.0})
+        print(writer.stats())
+        writer.close()
+    """
+
+    def __init__(self, svr, rate=50.0, script_id="svr", ack=False, ack_timeout=1.0):
+        """
+        :param svr: connected TMSVR
+        :param rate: frames per second at most
+        :param script_id: transaction ID of the frames, not used with ack
+        :param ack: track the response of the robot to every frame
+        :param ack_timeout: seconds to wait for a response before the frame is counted as rejected
+        """
+        self.svr = svr
+        self.interval = 1.0 / rate
+        self.script_id = script_id
+        self.ack = ack
+        self.ack_timeout = ack_timeout
+        self.landed = {}
+        self.acked = 0
+        self.rejected = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.writes = 0
+        self.merged = 0
+        self.frames = 0
+        self.items_sent = 0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def set(self, item_name, value):
+        """Write an item with the next frame, replaces a value of the item that was not sent yet"""
+        with self.lock:
+            if item_name in self.pending:
+                self.merged += 1
+            self.pending[item_name] = value
+            self.writes += 1
+
+    def update(self, items):
+        """set() every item of a dict"""
+        with self.lock:
+            self.merged += len(self.pending.keys() & items.keys())
+            self.pending.update(items)
+            self.writes += len(items)
+
+    def flush(self):
+        """Send the pending items now, kept for the next tick (unless replaced) when the write fails"""
+        with self.lock:
+            items = self.pending
+            self.pending = {}
+        if not items:
+            return
+        try:
+            if self.ack:
+                self.svr.send_acked(items, self.ack_timeout).add_done_callback(lambda f: self.write_done(f, items))
+            else:
+                self.svr.send_items(items, self.script_id)
+        except (OSError, ConnectionError) as e:
+            self.errors += 1
+            log.warning(f"Ethernet Slave write failed: {e}")
+            with self.lock:
+                self.pending = items | self.pending
+            return
+        self.frames += 1
+        self.items_sent += len(items)
+
+    def write_done(self, future, items):
+        if future.exception() is not None:
+            self.rejected += 1
+            log.warning(f"Ethernet Slave write not confirmed: {future.exception()}")
+        else:
+            self.acked += 1
+            self.landed.update(items)
+
+    def run(self):
+        next_tick = time.monotonic()
+        while not self.stop_event.is_set():
+            self.flush()
+            next_tick += self.interval
+            delay = next_tick - time.monotonic()
+            if delay < 0:
+                # Behind schedule, skip the missed ticks instead of sending them back to back
+                next_tick = time.monotonic()
+                delay = 0
+            self.stop_event.wait(delay)
+        self.flush()
+
+    def stats(self):
+        """Counters: item writes requested, merged (never sent), frames and items sent, failed frames, frames
+        confirmed and rejected by the robot (with ack)"""
+        with self.lock:
+            queued = len(self.pending)
+        return {"writes": self.writes, "merged": self.merged, "frames": self.frames, "items_sent": self.items_sent,
+                "queued": queued, "errors": self.errors, "acked": self.acked, "rejected": self.rejected}
+
+    def close(self):
+        """Send what is still pending and stop the thread"""
+        self.stop_event.set()
+        self.thread.join()
+
+
+class ScriptIdAllocator:
+    """Script IDs and QueueTag numbers of the scripts in flight.
+
+    Script IDs count up to id_space - 1 and wrap back to 1 (the robot uses 0 for its own messages), skipping the
+    IDs still waiting for their reply. QueueTag numbers (1 to 15 on the controller) are handed out round robin and
+    stay live until the robot reports the tag as done, so a live ID or tag is never given out twice.
+    """
+    TAG_MIN = 1
+    TAG_MAX = 15
+
+    def __init__(self, id_space=100000):
+        self.id_space = id_space
+        self.next_id = 1
+        self.next_tag = self.TAG_MIN
+        # Script IDs as str, the way the replies carry them
+        self.live_ids = set()
+        # tag number -> script ID it was given to
+        self.live_tags = {}
+
+    def allocate_id(self, script_id=None):
+        """Next free script ID, or reserve script_id when given
+
+        :raises ValueError: script_id is still in flight
+        :raises RuntimeError: every ID of the space is in flight
+        """
+        if script_id is not None:
+            if str(script_id) in self.live_ids:
+                raise ValueError(f"Script ID {script_id} is still in flight")
+            self.live_ids.add(str(script_id))
+            return script_id
+        if len(self.live_ids) >= self.id_space - 1:
+            raise RuntimeError(f"All {self.id_space - 1} script IDs are in flight")
+        while str(self.next_id) in self.live_ids:
+            self.next_id = self.next_id % (self.id_space - 1) + 1
+        script_id = self.next_id
+        self.next_id = self.next_id % (self.id_space - 1) + 1
+        self.live_ids.add(str(script_id))
+        return script_id
+
+    def release_id(self, script_id):
+        self.live_ids.discard(str(script_id))
+
+    def tag_available(self):
+        return len(self.live_tags) < self.TAG_MAX - self.TAG_MIN + 1
+
+    def allocate_tag(self, script_id, tag=None):
+        """Next free QueueTag number, None when all of them are live, or reserve tag when given
+
+        :raises ValueError: tag is still live or out of the range of the controller
+        """
+        if tag is not None:
+            if not self.TAG_MIN <= tag <= self.TAG_MAX:
+                raise ValueError(f"QueueTag {tag} is not between {self.TAG_MIN} and {self.TAG_MAX}")
+            if tag in self.live_tags:
+                raise ValueError(f"QueueTag {tag} is still live")
+            self.live_tags[tag] = str(script_id)
+            return tag
+        if not self.tag_available():
+            return None
+        while self.next_tag in self.live_tags:
+            self.next_tag = self.next_tag + 1 if self.next_tag < self.TAG_MAX else self.TAG_MIN
+        tag = self.next_tag
+        self.next_tag = self.next_tag + 1 if self.next_tag < self.TAG_MAX else self.TAG_MIN
+        self.live_tags[tag] = str(script_id)
+        return tag
+
+    def release_tag(self, tag):
+        """:return: True if the tag was live"""
+        return self.live_tags.pop(tag, None) is not None
+
+    def tags_of(self, script_id):
+        return [tag for tag, owner in self.live_tags.items() if owner == str(script_id)]
+
+    def clear(self):
+        self.live_ids.clear()
+        self.live_tags.clear()
+
+    def counts(self):
+        """Outstanding work: scripts waiting for their reply and queue tags not reported as done"""
+        return {"scripts": len(self.live_ids), "queue_tags": len(self.live_tags)}
+
+
 class TMSCT(TMPacket):
-    def __init__(self, ip):
+    def __init__(self, ip, max_in_flight=100, port=5890, id_space=100000, tag_poll_interval=1.0, engine=None):
+        """
+        :param ip: IP of the robot
+        :param max_in_flight: maximum number of scripts sent and not answered yet, send blocks while it is reached
+        :param port: port of the listen node
+        :param id_space: script IDs go from 1 to id_space - 1
+        :param tag_poll_interval: seconds between status requests for the queue tags not done yet, in case a
+            notification is missed, None to only listen for the notifications
+        :param engine: IOEngine serving the socket, None to read the replies with a thread of its own
+        """
         super().__init__()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((ip, 5890))
-        self.data = ""
+        self.sock.connect((ip, port))
+        self.data = RingBuffer()
+        self.buffer_size = 2048
+        self.ip = ip
+        self.port = port
+        self.engine = engine
 
         self.header = "TMSCT"
-        self.ID = 0
+        self.init_tracking(threading.BoundedSemaphore(max_in_flight), queue.Queue(100), id_space)
+
+        self.tag_poll_interval = tag_poll_interval
+        self.poll_timer = None
+        self.reader_thread = None
+        self.open_replies()
+
+        # Second connection for stop/pause/resume, never behind the scripts queued on this one
+        self.control_lane = None
+        self.control_latency = np.zeros(1000)
+        self.control_count = 0
+
+    def open_replies(self):
+        """Start matching the replies, with the IOEngine or with a thread of its own"""
+        self.reading = True
+        # Set by close, every connection has its own so a poller never outlives the connection it was started for
+        self.stop_polling = threading.Event()
+        if self.engine is not None:
+            self.connection = self.engine.add_packet(self, f"{self.ip}:{self.port}")
+            if self.tag_poll_interval:
+                self.poll_timer = self.engine.call_every(self.tag_poll_interval, self.request_tag_status)
+        else:
+            # The replies are read by a thread and matched to the futures returned by send
+            self.reader_thread = threading.Thread(target=self.read_replies, daemon=True)
+            self.reader_thread.start()
+            if self.tag_poll_interval:
+                threading.Thread(target=self.poll_tags, args=(self.stop_polling,), daemon=True).start()
+
+    def reconnect(self, timeout=5):
+        """Open a new connection after the link dropped.
+
+        The scripts in flight fail with ConnectionError, the ones sent with queue=True and not confirmed by their
+        QueueTag stay in the journal, see resume. The control lane is a link of its own and is kept, see
+        ConnectionManager.watch_tmsct.
+        """
+        connection = self.connection
+        self.close_connection()
+        if connection is not None:
+            # The old connection shares self.data and fails the pending futures when it closes, both must be
+            # done before the new connection is used
+            connection.close_wait(timeout)
+        elif self.reader_thread is not None and self.reader_thread is not threading.current_thread():
+            self.reader_thread.join(timeout)
+        self.connection = None
+        self.data.clear()
+        self.sock = socket.create_connection((self.ip, self.port), timeout)
+        self.sock.settimeout(None)
+        self.open_replies()
+
+    def open_control_lane(self):
+        """Open the connection used by control to send commands ahead of everything queued on this one"""
+        if self.control_lane is None:
+            self.control_lane = TMSCT(self.ip, max_in_flight=10, port=self.port, tag_poll_interval=None,
+                                      engine=self.engine)
+        return self.control_lane
+
+    def control(self, commands, timeout=None):
+        """Send a control command (StopAndClearBuffer, Pause, Resume, ...) through the control lane
+
+        The command does not wait behind the scripts queued on the main connection (falls back to it when the
+        lane is not open). The time until the reply is recorded, see control_stats.
+
+        :return: future of the reply
+        """
+        lane = self.control_lane if self.control_lane is not None else self
+        start = time.perf_counter()
+        future = lane.send(commands, timeout=timeout)
+        future.add_done_callback(lambda f: self.record_control_latency(time.perf_counter() - start))
+        return future
+
+    def record_control_latency(self, latency):
+        self.control_latency[self.control_count % len(self.control_latency)] = latency
+        self.control_count += 1
+
+    def control_stats(self):
+        """Latency in ms from sending a control command to its reply, over the last 1000 commands"""
+        n = min(self.control_count, len(self.control_latency))
+        if not n:
+            return {"count": 0}
+        latency = self.control_latency[:n] * 1000
+        last = self.control_latency[(self.control_count - 1) % len(self.control_latency)] * 1000
+        return {"count": self.control_count,
+                "last_ms": float(last),
+                "mean_ms": float(latency.mean()),
+                "p99_ms": float(np.percentile(latency, 99)),
+                "max_ms": float(latency.max())}
+
+    def cancel_queued(self):
+        """Drop what is queued on this connection before a stop clears the buffer of the robot
+
+        The frames not written to the socket yet are dropped, the scripts waiting for their reply and the tag
+        waiters fail with ScriptsStopped (so a TrajectoryStreamer stops), and the queue tags are freed. Batches
+        being sent by send_many stop before their next write.
+        """
+        self.stops += 1
+        if self.connection is not None:
+            self.connection.discard_output()
+        error = ScriptsStopped("Stopped before the script was executed")
+        with self.lock:
+            futures = list(self.pending.values())
+            for waiters in self.tag_waiters.values():
+                futures.extend(waiters)
+            self.pending.clear()
+            self.tag_waiters.clear()
+            self.ids.clear()
+            self.tag_released.notify_all()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def clear_journal(self):
+        """Forget the queued scripts, after the buffer of the robot was cleared they must not be resumed"""
+        with self.lock:
+            self.journal.clear()
+
+    def resume(self):
+        """Send again, in order, the scripts sent with queue=True whose QueueTag was not confirmed
+
+        The controller may still hold some of them in its motion buffer (the link dropped before their QueueTag was
+        reported), those run twice unless the buffer was cleared first (StopAndClearBuffer).
+
+        :return: futures of the scripts sent again
+        """
+        with self.lock:
+            scripts = list(self.journal.values())
+            self.journal.clear()
+        if scripts:
+            log.info(f"Resuming {len(scripts)} scripts after QueueTag {self.last_confirmed_tag}")
+        return [self.send(commands, queue=True) for commands in scripts]
+
+    def init_tracking(self, window, messages, id_space):
+        """
+        :param window: semaphore limiting the scripts in flight
+        :param messages: queue for the messages that do not answer a request
+        :param id_space: size of the script ID space
+        """
+        self.window = window
+        self.messages = messages
+        self.ids = ScriptIdAllocator(id_space)
+        self.lock = threading.Lock()
+        self.tag_released = threading.Condition(self.lock)
+        # script ID (str) -> future of the reply, in the order the scripts were sent
+        self.pending = {}
+        # TMSTA subcommand (and tag number for 01) -> futures waiting for its next response
+        self.status_waiters = {}
+        # QueueTag number -> futures waiting for it to be done
+        self.tag_waiters = {}
+        # script ID -> commands of the scripts sent with queue=True whose QueueTag is not done, in order
+        self.journal = {}
+        self.last_confirmed_tag = None
+        # Number of stops, a batch or a stream started before a stop is not sent any further
+        self.stops = 0
+
+    def send(self, commands, script_id=None, queue=False, timeout=None, tag=None):
+        """Send a script without waiting for it to be executed
+
+        :param script_id: ID of the script, the next free one when None
+        :param queue: add a QueueTag after the commands, its number is set as future.queue_tag
+        :param timeout: seconds to wait for a free slot in the in-flight window (and a free queue tag), None waits
+            forever
+        :param tag: QueueTag number reserved for commands that contain their own QueueTag(tag, wait), so the
+            allocator does not give it to another script while it is live. Raises ValueError when it is live
+        :return: concurrent.futures.Future with the reply of the listen node ("OK", or "OK;" and the lines with
+            warnings), a rejected script sets a ListenNodeError
+        """
+        if not self.window.acquire(timeout=timeout):
+            raise TimeoutError(f"{len(self.pending)} scripts in flight")
+        future = Future()
+        future.add_done_callback(lambda f: self.window.release())
+        try:
+            script_id, tag = self.track(script_id, future, queue, timeout, commands, tag)
+            self.write_frame(self.build_frame("TMSCT", self.build_script(commands, script_id, tag)))
+        except BaseException:
+            self.untrack(future)
+            raise
+        return future
+
+    def send_many(self, scripts, queue=False, timeout=None):
+        """Send several scripts with as few socket writes as the in-flight window allows
+
+        The frames are collected in a FrameEncoder and written with one sendall, the batch is only written early
+        when the window is full and slots have to come back from the replies.
+
+        :param scripts: list of scripts, each one a command or a list of commands
+        :return: list of futures, see send
+        """
+        encoder = FrameEncoder()
+        futures = []
+        batch = []
+        stops = self.stops
+        try:
+            for commands in scripts:
+                # Slots and queue tags come back only with the replies to the frames already written
+                if queue and not self.ids.tag_available() and len(encoder):
+                    self.write_frame(encoder.take())
+                    batch = []
+                if not self.window.acquire(blocking=False):
+                    if len(encoder):
+                        self.write_frame(encoder.take())
+                        batch = []
+                    if not self.window.acquire(timeout=timeout):
+                        raise TimeoutError(f"{len(self.pending)} scripts in flight")
+                if self.stops != stops:
+                    self.window.release()
+                    raise ScriptsStopped("Stopped while the scripts were sent")
+                future = Future()
+                future.add_done_callback(lambda f: self.window.release())
+                batch.append(future)
+                script_id, tag = self.track(None, future, queue, timeout, commands)
+                encoder.add("TMSCT", self.build_script(commands, script_id, tag))
+                futures.append(future)
+            if len(encoder):
+                self.write_frame(encoder.take())
+        except BaseException:
+            for future in batch:
+                self.untrack(future)
+            raise
+        return futures
+
+    def track(self, script_id, future, queue=False, timeout=None, commands=None, tag=None):
+        """Give the script its ID (and queue tag) and register the future of its reply
+
+        :param tag: tag number of a QueueTag already in the commands, reserved for the script
+        :return: script ID, number of the queue tag to add after the commands or None
+        """
+        with self.tag_released:
+            if queue and not self.tag_released.wait_for(self.ids.tag_available, timeout):
+                raise TimeoutError("All queue tags are in use")
+            script_id = self.ids.allocate_id(script_id)
+            if tag is not None:
+                try:
+                    self.ids.allocate_tag(script_id, tag)
+                except ValueError:
+                    self.ids.release_id(script_id)
+                    raise
+            elif queue:
+                tag = self.ids.allocate_tag(script_id)
+            self.pending[str(script_id)] = future
+            if queue:
+                self.journal[str(script_id)] = commands
+        future.script_id = script_id
+        future.queue_tag = tag
+        return script_id, tag if queue else None
+
+    def untrack(self, future):
+        """Forget a script that could not be sent and free its ID, tag and slot"""
+        script_id = getattr(future, "script_id", None)
+        resolved = []
+        if script_id is not None:
+            with self.lock:
+                if self.pending.get(str(script_id)) is future:
+                    del self.pending[str(script_id)]
+                resolved = self.release_script(script_id, ConnectionError(f"Script {script_id} was not sent"))
+        self.resolve(resolved)
+        future.cancel()
+
+    def release_script(self, script_id, error=None):
+        """Free the ID of an answered script, and its queue tags if it was not accepted (called with lock held)
+
+        :param error: why the script was not accepted, None if it was
+        :return: (future, result) of the tag waiters to resolve
+        """
+        self.ids.release_id(script_id)
+        resolved = []
+        if error is not None:
+            self.journal.pop(str(script_id), None)
+            for tag in self.ids.tags_of(script_id):
+                resolved.extend(self.finish_tag(tag, error))
+        return resolved
+
+    def finish_tag(self, tag, result):
+        """Free a queue tag that is done (called with lock held)
+
+        :return: (future, result) of its waiters to resolve
+        """
+        script_id = self.ids.live_tags.get(tag)
+        if result is True and script_id in self.journal:
+            # The motions are executed in order, every script before this one is done too
+            self.last_confirmed_tag = tag
+            for done_id in list(self.journal):
+                del self.journal[done_id]
+                if done_id == script_id:
+                    break
+        self.release_tag(tag)
+        return [(future, result) for future in self.tag_waiters.pop(tag, [])]
 
-    def send(self, commands, script_id=None, queue=False):
+    def release_tag(self, tag):
+        if self.ids.release_tag(tag):
+            self.tag_released.notify_all()
 
-        if script_id is None:
-            script_id = self.ID
+    @staticmethod
+    def resolve(resolved):
+        for future, result in resolved:
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def new_future(self):
+        return Future()
+
+    def tag_done(self, tag):
+        """Future resolved when a QueueTag is reported as done (TMSTA 01)
+
+        Usage:
+            motion = listen_node.send(commands, queue=True)
+            listen_node.tag_done(motion).result(timeout=30)
+
+        :param tag: tag number, or the future returned by send(queue=True)
+        :return: future set to True when the tag is done, or failing with the error of the script of the tag
+        """
+        future = self.new_future()
+        with self.lock:
+            if not isinstance(tag, int):
+                script = tag
+                tag = script.queue_tag
+                if self.ids.live_tags.get(tag) != str(script.script_id):
+                    # Already done, or released because the script was rejected
+                    if script.done() and script.exception() is not None:
+                        future.set_exception(script.exception())
+                    else:
+                        future.set_result(True)
+                    return future
+            self.tag_waiters.setdefault(tag, []).append(future)
+        return future
+
+    def tags_to_poll(self):
+        """Tags to ask the status of: the ones waited for and the live ones of the scripts already accepted"""
+        with self.lock:
+            tags = {tag for tag, waiters in self.tag_waiters.items() if waiters}
+            tags.update(tag for tag, script_id in self.ids.live_tags.items() if script_id not in self.ids.live_ids)
+        return sorted(tags)
+
+    def poll_tags(self, stopped):
+        """Ask the status of the live tags every tag_poll_interval until stopped is set"""
+        while not stopped.wait(self.tag_poll_interval):
+            try:
+                self.request_tag_status()
+            except OSError:
+                return
 
+    def request_tag_status(self):
+        for tag in self.tags_to_poll():
+            self.write_frame(self.build_frame("TMSTA", f"01,{tag:02d}".encode('utf-8')))
 
-        script_data = f"{script_id},"
+    def outstanding(self):
+        """Counts of the scripts waiting for their reply and of the queue tags not done yet"""
+        with self.lock:
+            return self.ids.counts()
 
-        if script_id == 0:
-            queue_script = [f"QueueTag(9)"]
-        else:
-            queue_script = [f"QueueTag({script_id-1})"]
+    def wait_all(self, timeout=None):
+        """Wait until every script sent got its reply
 
-        if queue:
-            script_data = script_data + queue_script[0] + "\r\n"
+        :return: True if all of them were answered within the timeout
+        """
+        with self.lock:
+            futures = list(self.pending.values())
+        return not wait(futures, timeout).not_done
 
-        if isinstance(commands, list):
-            # if queue:
-            #     commands.extend(queue_script)
-            for command in commands:
-                if command == commands[-1]:
-                    script_data = script_data + command
-                else:
-                    script_data = script_data + command + "\r\n"
-        else:
-            script_data = script_data + commands + "\r\n"
-            # if queue:
-            #     script_data = script_data + "\r\n" + queue_script[0]
+    @property
+    def in_flight(self):
+        return len(self.pending)
 
-        data_length = len(script_data)
-        # Convert string to bytes
-        self.data_block = self.header + "," + str(data_length) + ',' + script_data + ','
-        data_msg = self.data_block.encode("utf-8")
+    @staticmethod
+    def build_script(commands, script_id, tag=None):
+        """Data block of a script
+
+        :param commands: a command or a list of commands
+        :param script_id: ID of the script
+        :param tag: QueueTag number added after the commands, None for no tag
+        :return: data block as bytes
+        """
+        if isinstance(commands, str):
+            commands = [commands]
+        if tag is not None:
+            commands = list(commands) + [f"QueueTag({tag})"]
+        return f"{script_id},".encode("utf-8") + "\r\n".join(commands).encode("utf-8")
+
+    def request_status(self, subcommand, *args):
+        """Send a TMSTA request
+
+        :return: future of the fields of the response after the subcommand
+        """
+        future = Future()
+        with self.lock:
+            self.status_waiters.setdefault(self.status_key(subcommand, *args), []).append(future)
+        self.write_frame(self.build_frame("TMSTA", ",".join((subcommand,) + args).encode('utf-8')))
+        return future
 
-        if self.ID < 9:
-            self.ID += 1
-        else:
-            self.ID = 0
-        csum = self.checksum_calc(data_msg)
-        msg = b'$' + data_msg + b'*' + csum + b'\r\n'
-        self.sock.send(msg)
-
-    def listen_ready(self):
-        self.sock.send(b'$TMSTA,2,00,*41\r\n')
-        self.data = self.sock.recv(2048).decode("utf-8")
-        data_list = self.data.split(",")
-        # print(data_list)
-        while data_list[0] != "$TMSTA":
-            self.data = self.sock.recv(2048).decode("utf-8")
-            data_list = self.data.split(",")
-        print(data_list)
-
-        if data_list[3] == "true":
-            return [True, data_list[4]]
+    @staticmethod
+    def status_key(subcommand, *args):
+        """Responses to 01 are told apart by their tag number, the other ones come in the order of the requests"""
+        if subcommand == "01" and args:
+            return f"01,{int(args[0]):02d}"
+        return subcommand
+
+    def listen_ready(self, timeout=10):
+        fields = self.request_status("00").result(timeout)
+        if fields[0] == "true":
+            return [True, fields[1]]
         else:
-            return [False, data_list[4]]
+            return [False, fields[1] if len(fields) > 1 else ""]
+
+    def tag_status(self, tag_number, timeout=10):
+        """:return: "true" when the QueueTag is done, "false" when not, "none" when the tag does not exist"""
+        return self.request_status("01", f"{tag_number:02d}").result(timeout)[1]
+
+    def read_replies(self):
+        error = None
+        while self.reading:
+            try:
+                if not self.recv():
+                    break
+            except OSError as e:
+                error = e
+                break
+            while self.data and self.deserialize():
+                self.parse_data()
+        self.connection_closed(error)
 
     def parse_data(self):
-        pass
+        """Match the frame in data_block to the script or status request it answers"""
+        fields = str(self.data_block, 'utf-8').split(',')
+        resolved = []
+        handled = False
+        with self.lock:
+            if self.header == "TMSCT" and len(fields) > 1:
+                reply = ",".join(fields[1:])
+                if fields[0] in self.pending and (reply.startswith("OK") or reply.startswith("ERROR")):
+                    result = reply if reply.startswith("OK") else ListenNodeError(fields[0], reply)
+                    resolved.append((self.pending.pop(fields[0]), result))
+                    resolved.extend(self.release_script(fields[0], None if reply.startswith("OK") else result))
+            elif self.header == "TMSTA" and fields:
+                key = fields[0]
+                if fields[0] == "01" and len(fields) > 2:
+                    key = self.status_key(*fields[:2])
+                    handled = True
+                    tag = int(fields[1])
+                    # "none" only means done for a tag of an accepted script, the robot may not have reached it yet
+                    if fields[2] == "true" or (fields[2] == "none" and tag in self.ids.live_tags and
+                                               self.ids.live_tags[tag] not in self.ids.live_ids):
+                        resolved.extend(self.finish_tag(tag, True))
+                if self.status_waiters.get(key):
+                    resolved.append((self.status_waiters[key].pop(0), fields[1:]))
+            elif self.header == "CPERR" and self.pending:
+                # The packet can not be matched to a script, fail the oldest one
+                log.warning(f"Listen node communication error {fields[0]}")
+                script_id = next(iter(self.pending))
+                error = ListenNodeError(script_id, f"CPERR {fields[0]}")
+                resolved.append((self.pending.pop(script_id), error))
+                resolved.extend(self.release_script(script_id, error))
+        if not resolved and not handled:
+            self.message_received(self.header, fields)
+        self.resolve(resolved)
+
+    def message_received(self, header, fields):
+        """Keep the messages that do not answer a request (TMSTA 90-99, "Listen1" when entering the node, ...)"""
+        if self.messages.full():
+            self.messages.get_nowait()
+        self.messages.put_nowait((header, fields))
+
+    def connection_closed(self, exc):
+        error = exc or ConnectionError("Listen node connection closed")
+        with self.lock:
+            futures = list(self.pending.values())
+            for waiters in list(self.status_waiters.values()) + list(self.tag_waiters.values()):
+                futures.extend(waiters)
+            self.pending.clear()
+            self.status_waiters.clear()
+            self.tag_waiters.clear()
+            self.ids.clear()
+            self.tag_released.notify_all()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+        if self.messages.full():
+            self.messages.get_nowait()
+        self.messages.put_nowait(None)
 
     def recv(self):
-        self.sock.recv()
-        # self.data = listen_node.data
+        return self.data.recv_into(self.sock, self.buffer_size)
 
     def close(self):
+        if self.control_lane is not None:
+            self.control_lane.close()
+            self.control_lane = None
+        self.close_connection()
+
+    def close_connection(self):
+        """Close the main connection only, the control lane stays open"""
+        self.reading = False
+        self.stop_polling.set()
+        if self.poll_timer is not None:
+            self.engine.cancel(self.poll_timer)
+            self.poll_timer = None
+        if self.connection is not None:
+            self.connection.close()
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.sock.close()
@@ -0,0 +1,93 @@
+import time
+from collections import deque
+from tm_packet import ListenNodeError, ScriptsStopped, log
+
+
+class TrajectoryStreamer:
+    """Streams a long list of motion commands to the listen node.
+
+    The commands are packed into scripts of at most max_chunk_bytes / max_chunk_lines, each one ending with a
+    QueueTag. A new chunk is sent only while fewer than target_depth chunks are queued on the controller, the
+    QueueTag completions (TMSCT.tag_done) tell when a chunk has been executed. The commands are read from the
+    iterable only when they are needed, so a generator can stream a path of any length.
+
+    Usage:
+        streamer = TrajectoryStreamer(listen_node, target_depth=4)
+        streamer.stream(f"Line(\"CPP\",{x},{y},{z},90,0,90,100,200,0,false)" for x, y, z in points)
+    """
+
+    def __init__(self, listen_node, max_chunk_bytes=4000, max_chunk_lines=100, target_depth=4):
+        """
+        :param listen_node: connected TMSCT
+        :param max_chunk_bytes: maximum size of the commands of a chunk
+        :param max_chunk_lines: maximum number of commands in a chunk
+        :param target_depth: number of chunks kept queued on the controller
+        """
+        self.listen_node = listen_node
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_chunk_lines = max_chunk_lines
+        self.target_depth = target_depth
+        # Futures of the chunks sent whose QueueTag is not done yet, oldest first
+        self.queued = deque()
+        self.stats = {}
+
+    def chunks(self, commands):
+        """Yields lists of commands within the size limits of a chunk"""
+        chunk = []
+        chunk_bytes = 0
+        for command in commands:
+            size = len(command) + 2
+            if chunk and (chunk_bytes + size > self.max_chunk_bytes or len(chunk) == self.max_chunk_lines):
+                yield chunk
+                chunk = []
+                chunk_bytes = 0
+            chunk.append(command)
+            chunk_bytes += size
+        if chunk:
+            yield chunk
+
+    def stream(self, commands, wait_done=False, timeout=None):
+        """Send all the commands
+
+        :param commands: iterable of motion commands (str)
+        :param wait_done: also wait until the last chunk has been executed
+        :param timeout: seconds to wait for a chunk to be executed before giving up, None waits forever
+        :return: statistics of the stream
+        :raises ListenNodeError: a chunk was rejected, the chunks after it are not sent
+        :raises ScriptsStopped: the robot was stopped while streaming
+        """
+        self.queued.clear()
+        self.stats = {"chunks": 0, "commands": 0, "max_depth": 0, "elapsed": 0.0}
+        start = time.perf_counter()
+        stops = self.listen_node.stops
+        for chunk in self.chunks(commands):
+            while len(self.queued) >= self.target_depth:
+                self.wait_oldest(timeout)
+            if self.listen_node.stops != stops:
+                raise ScriptsStopped(f"Stopped after {self.stats['chunks']} chunks")
+            self.queued.append(self.listen_node.send(chunk, queue=True, timeout=timeout))
+            self.stats["chunks"] += 1
+            self.stats["commands"] += len(chunk)
+            self.stats["max_depth"] = max(self.stats["max_depth"], len(self.queued))
+            self.check_replies()
+        while self.queued and wait_done:
+            self.wait_oldest(timeout)
+        self.check_replies()
+        self.stats["elapsed"] = time.perf_counter() - start
+        log.info(f"Streamed {self.stats['commands']} commands in {self.stats['chunks']} chunks")
+        return self.stats
+
+    def wait_oldest(self, timeout=None):
+        """Wait until the oldest queued chunk has been executed"""
+        # Fails with the error of the chunk if it was rejected
+        self.listen_node.tag_done(self.queued[0]).result(timeout)
+        self.queued.popleft()
+
+    def check_replies(self):
+        """Raise the error of the first rejected chunk"""
+        for future in self.queued:
+            if future.done() and future.exception() is not None:
+                error = future.exception()
+                if isinstance(error, ListenNodeError):
+                    log.error(f"Chunk {future.script_id} rejected: {error.reply}")
+                raise error